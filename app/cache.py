@@ -0,0 +1,96 @@
+"""
+Кэш read-моделей админ-панели (TTL + LRU).
+
+Записи сгруппированы по имени (users, stats, status). Функции записи в БД
+сбрасывают затронутые группы через invalidate(), TTL ограничивает
+устаревание для изменений, которые явно не сбрасываются.
+Закэшированные значения общие для всех вызовов — их нельзя изменять.
+"""
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Dict, Hashable, Tuple
+
+from app.config import ADMIN_CACHE_TTL_SEC, ADMIN_CACHE_MAX_ENTRIES
+
+# Группы кэша
+USERS = "users"
+STATS = "stats"
+STATUS = "status"
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Словарь с временем жизни записей и вытеснением давно не читанных"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        # Поколение группы растёт при каждом сбросе: результат, посчитанный
+        # до сброса, не попадёт в кэш
+        self._generations: Dict[str, int] = {}
+
+    def generation(self, name: str) -> int:
+        return self._generations.get(name, 0)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *names: str):
+        """Сбросить все записи указанных групп (ключ — (группа, ...))"""
+        for name in names:
+            self._generations[name] = self.generation(name) + 1
+        for key in [key for key in self._data if key[0] in names]:
+            del self._data[key]
+
+    def clear(self):
+        for name in list(self._generations):
+            self._generations[name] += 1
+        self._data.clear()
+
+
+_cache = TTLCache(ADMIN_CACHE_MAX_ENTRIES, ADMIN_CACHE_TTL_SEC)
+
+
+def cached(name: str):
+    """Кэшировать результат async-функции в группе name (ключ — аргументы)"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = (name, func.__qualname__, args, tuple(sorted(kwargs.items())))
+            value = _cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            generation = _cache.generation(name)
+            value = await func(*args, **kwargs)
+            if _cache.generation(name) == generation:
+                _cache.set(key, value)
+            return value
+        return wrapper
+    return decorator
+
+
+def invalidate(*names: str):
+    """Сбросить группы кэша после записи в БД"""
+    _cache.invalidate(*names)
+
+
+def clear_cache():
+    """Сбросить весь кэш"""
+    _cache.clear()
@@ -9,9 +9,40 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "8564179994:AAEoFdu78Tcll0rgtwWah_Kcx-R_Zyx-5
 # ID администратора (можно получить через @userinfobot)
 ADMIN_ID = int(os.getenv("ADMIN_ID", "1015433406"))
 
+# Адрес Bot API (пусто — api.telegram.org; для локального/фейкового сервера — его URL)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Webhook: публичный адрес (за reverse proxy), путь, секрет и локальный адрес сервера
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+HEALTH_PATH = os.getenv("HEALTH_PATH", "/health")
+
+# Шардирование: число процессов-воркеров (1 — всё в одном процессе)
+# и срок аренды шарда / роли ведущего (сек)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+LEASE_TTL_SEC = float(os.getenv("LEASE_TTL_SEC", "30"))
+
 # Интервал между сообщениями в минутах
 MESSAGE_INTERVAL_MINUTES = 32
 
+# Доставка: общий лимит (сообщений/сек) и минимальный интервал между
+# сообщениями в один чат (одновременность — OUTBOX_WORKERS, повторы — в outbox)
+TELEGRAM_RATE_LIMIT_PER_SEC = float(os.getenv("TELEGRAM_RATE_LIMIT_PER_SEC", "25"))
+TELEGRAM_CHAT_INTERVAL_SEC = float(os.getenv("TELEGRAM_CHAT_INTERVAL_SEC", "1"))
+
+# Outbox: число воркеров доставки (= одновременных запросов к Telegram),
+# попыток до dead-letter и задержки повторов
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "10"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE_SEC = float(os.getenv("OUTBOX_BACKOFF_BASE_SEC", "5"))
+OUTBOX_BACKOFF_MAX_SEC = float(os.getenv("OUTBOX_BACKOFF_MAX_SEC", "600"))
+
 # Рабочее окно (часы, когда бот отправляет сообщения)
 WORK_HOURS_START = 10  # С 10:00
 WORK_HOURS_END = 22    # До 22:00
@@ -19,5 +50,49 @@ WORK_HOURS_END = 22    # До 22:00
 # Путь к базе данных
 DATABASE_PATH = "trainer.db"
 
+# Размер пула соединений с БД
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# Сколько секунд ждать снятия блокировки БД другим соединением
+DB_BUSY_TIMEOUT_SEC = float(os.getenv("DB_BUSY_TIMEOUT_SEC", "10"))
+
+# Размер страничного кэша SQLite на одно соединение (КиБ)
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+
+# Групповая фиксация записей логов: окно ожидания (мс) и максимум операций в пачке
+DB_WRITE_BATCH_MS = float(os.getenv("DB_WRITE_BATCH_MS", "5"))
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "100"))
+
+# Экспорт: размер порции строк при выгрузке и сжатие CSV в gzip
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "500"))
+EXPORT_COMPRESS = os.getenv("EXPORT_COMPRESS", "0") == "1"
+
+# Хранение файлов экспорта: максимальный возраст (дни) и общий объём папки (МБ)
+EXPORT_RETENTION_DAYS = float(os.getenv("EXPORT_RETENTION_DAYS", "7"))
+EXPORT_MAX_TOTAL_MB = float(os.getenv("EXPORT_MAX_TOTAL_MB", "200"))
+
+# Экспорт в памяти без записи в exports/ и порог (МБ), сверх которого
+# буфер вытесняется во временный файл
+EXPORT_IN_MEMORY = os.getenv("EXPORT_IN_MEMORY", "0") == "1"
+EXPORT_MEMORY_MAX_MB = float(os.getenv("EXPORT_MEMORY_MAX_MB", "16"))
+
+# Кэш данных админ-панели: время жизни записи (сек) и максимум записей
+ADMIN_CACHE_TTL_SEC = float(os.getenv("ADMIN_CACHE_TTL_SEC", "30"))
+ADMIN_CACHE_MAX_ENTRIES = int(os.getenv("ADMIN_CACHE_MAX_ENTRIES", "128"))
+
+# Ручная рассылка (/send_now): пользователей в одной порции и минимальный
+# интервал между обновлениями сообщения с прогрессом (сек)
+SEND_JOB_BATCH_SIZE = int(os.getenv("SEND_JOB_BATCH_SIZE", "100"))
+SEND_JOB_PROGRESS_SEC = float(os.getenv("SEND_JOB_PROGRESS_SEC", "2"))
+
+# Логирование: файл, уровень, формат (text или json), ротация по размеру (МБ)
+# и по времени (when для TimedRotatingFileHandler), сколько копий хранить
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_MAX_MB = float(os.getenv("LOG_MAX_MB", "10"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "14"))
+
 # Часовой пояс
 TIMEZONE = "Europe/Moscow"
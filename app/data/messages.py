@@ -277,16 +277,16 @@ MESSAGES = [
     },
 ]
 
+# Индекс для поиска сообщения по номеру за O(1)
+_MESSAGES_BY_INDEX = {msg["index"]: msg for msg in MESSAGES}
+
 def get_all_messages():
     """Возвращает все сообщения сценария"""
     return MESSAGES
 
 def get_message_by_index(index: int):
     """Возвращает сообщение по индексу"""
-    for msg in MESSAGES:
-        if msg["index"] == index:
-            return msg
-    return None
+    return _MESSAGES_BY_INDEX.get(index)
 
 def get_total_messages_count():
     """Возвращает общее количество сообщений"""
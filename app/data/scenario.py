@@ -0,0 +1,94 @@
+"""
+Скомпилированный сценарий тренировки.
+
+Сценарий не меняется, пока бот работает, поэтому собирается один раз при
+запуске: сообщения индексируются по номеру и категории, а итоговый текст
+для отправки (с Markdown-заголовком) рендерится заранее.
+"""
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from app.data.messages import get_all_messages
+
+
+class ScenarioMessage(NamedTuple):
+    """Сообщение сценария вместе с готовым текстом для отправки"""
+    index: int
+    text: str
+    category: str
+    difficulty: str
+    rendered: str
+
+
+def render_message(index: int, text: str, category: str) -> str:
+    """Текст тренировочного сообщения в том виде, в котором его получает пользователь"""
+    return f"📨 *Сообщение #{index}*\n\n_{category}_\n\n{text}"
+
+
+def render_scripts_preview(messages: Tuple[ScenarioMessage, ...], limit: int = 10) -> str:
+    """Текст для кнопки «📄 Скрипты»: первые limit сообщений с превью"""
+    text = "📄 *Сценарий тренировки:*\n\n"
+
+    for msg in messages[:limit]:
+        text += f"*{msg.index}.* _{msg.category}_\n"
+        # Обрезаем длинные сообщения
+        preview = msg.text[:100] + "..." if len(msg.text) > 100 else msg.text
+        text += f"{preview}\n\n"
+
+    if len(messages) > limit:
+        text += f"_...и ещё {len(messages) - limit} сообщений_"
+
+    return text
+
+
+class Scenario:
+    """Неизменяемый сценарий с O(1) доступом по номеру сообщения"""
+
+    __slots__ = ("messages", "total", "by_index", "by_category", "scripts_preview")
+
+    def __init__(self, messages: List[Dict]):
+        compiled = []
+        for msg in sorted(messages, key=lambda m: m['index']):
+            category = msg.get('category', 'Общее')
+            compiled.append(ScenarioMessage(
+                index=msg['index'],
+                text=msg['text'],
+                category=category,
+                difficulty=msg.get('difficulty', ''),
+                rendered=render_message(msg['index'], msg['text'], category),
+            ))
+
+        by_category: Dict[str, List[ScenarioMessage]] = {}
+        for msg in compiled:
+            by_category.setdefault(msg.category, []).append(msg)
+
+        self.messages: Tuple[ScenarioMessage, ...] = tuple(compiled)
+        self.total: int = len(compiled)
+        self.by_index: Mapping[int, ScenarioMessage] = MappingProxyType(
+            {msg.index: msg for msg in compiled}
+        )
+        self.by_category: Mapping[str, Tuple[ScenarioMessage, ...]] = MappingProxyType(
+            {category: tuple(items) for category, items in by_category.items()}
+        )
+        self.scripts_preview: str = render_scripts_preview(self.messages)
+
+    def get(self, index: int) -> Optional[ScenarioMessage]:
+        """Сообщение по номеру"""
+        return self.by_index.get(index)
+
+
+_scenario: Optional[Scenario] = None
+
+
+def build_scenario(messages: Optional[List[Dict]] = None) -> Scenario:
+    """Собрать сценарий (при запуске бота, после загрузки сообщений в БД)"""
+    global _scenario
+    _scenario = Scenario(messages if messages is not None else get_all_messages())
+    return _scenario
+
+
+def get_scenario() -> Scenario:
+    """Получить собранный сценарий (собирается при первом обращении)"""
+    if _scenario is None:
+        return build_scenario()
+    return _scenario
@@ -1,11 +1,106 @@
 """
 Модуль работы с базой данных SQLite
 """
+import asyncio
+import bisect
+import logging
+import time
 import aiosqlite
-from datetime import datetime
-from typing import Optional, List, Dict, Any
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, AsyncIterator, Awaitable, Callable, Tuple, Union
 
-from app.config import DATABASE_PATH
+from app.cache import cached, invalidate, clear_cache, USERS, STATS, STATUS
+from app.config import (
+    DATABASE_PATH,
+    DB_POOL_SIZE,
+    DB_BUSY_TIMEOUT_SEC,
+    DB_CACHE_SIZE_KB,
+    DB_WRITE_BATCH_MS,
+    DB_WRITE_BATCH_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Пул долгоживущих соединений (создаётся в init_db, закрывается в close_db)
+_pool: Optional[asyncio.Queue] = None
+_pool_connections: List[aiosqlite.Connection] = []
+_pool_lock: Optional[asyncio.Lock] = None
+
+# Шард процесса (номер, всего) в шардированном режиме: планировщик и outbox
+# работают только с пользователями, у которых user_id % всего == номер
+_shard: Optional[Tuple[int, int]] = None
+
+
+def set_shard(index: int, count: int):
+    """Ограничить рассылку этого процесса своим шардом пользователей"""
+    global _shard
+    _shard = (index, count) if count > 1 else None
+
+
+def _shard_sql(column: str) -> Tuple[str, List[int]]:
+    """Условие «пользователь из нашего шарда» для WHERE (пусто без шардирования)"""
+    if _shard is None:
+        return '', []
+    index, count = _shard
+    return f' AND {column} % ? = ?', [count, index]
+
+
+async def _open_connection() -> aiosqlite.Connection:
+    """Открыть новое соединение для пула"""
+    db = await aiosqlite.connect(DATABASE_PATH, timeout=DB_BUSY_TIMEOUT_SEC)
+    db.row_factory = aiosqlite.Row
+    await _configure_connection(db)
+    return db
+
+
+async def init_pool(size: int = DB_POOL_SIZE):
+    """Создать пул соединений (повторный вызов ничего не делает)"""
+    global _pool, _pool_lock
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+
+    async with _pool_lock:
+        if _pool is not None:
+            return
+        pool = asyncio.Queue()
+        for _ in range(max(1, size)):
+            db = await _open_connection()
+            _pool_connections.append(db)
+            pool.put_nowait(db)
+        _pool = pool
+
+
+async def close_db():
+    """Закрыть все соединения пула (дожидается возврата занятых соединений)"""
+    global _pool
+    await _stop_writer()
+    pool, _pool = _pool, None
+    if pool is None:
+        return
+    for _ in range(len(_pool_connections)):
+        db = await pool.get()
+        await db.close()
+    _pool_connections.clear()
+
+
+@asynccontextmanager
+async def _connection():
+    """
+    Взять соединение из пула на время операции.
+    Незавершённая транзакция откатывается перед возвратом соединения.
+    """
+    if _pool is None:
+        await init_pool()
+    pool = _pool
+    db = await pool.get()
+    try:
+        yield db
+    finally:
+        if db.in_transaction:
+            await db.rollback()
+        pool.put_nowait(db)
 
 
 async def get_connection():
@@ -13,55 +108,472 @@ async def get_connection():
     return await aiosqlite.connect(DATABASE_PATH)
 
 
-async def init_db():
-    """Инициализация базы данных - создание таблиц"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        # Таблица пользователей
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                full_name TEXT,
-                is_active INTEGER DEFAULT 0,
-                training_start_time TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица сообщений сценария
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_index INTEGER UNIQUE,
-                text TEXT NOT NULL,
-                category TEXT,
-                difficulty TEXT
-            )
-        ''')
-        
-        # Таблица логов (отправленные сообщения и ответы)
+# ===== Групповая фиксация записей (write-behind) =====
+# Вставки логов и ответы копятся в очереди несколько миллисекунд
+# (или до DB_WRITE_BATCH_SIZE операций) и фиксируются одной транзакцией.
+# Каждая операция выполняется в своей точке сохранения, поэтому ошибка
+# одной не откатывает остальные.
+
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+_write_queue: Optional[asyncio.Queue] = None
+_writer_task: Optional[asyncio.Task] = None
+
+
+def _log_write_error(future: asyncio.Future):
+    """Залогировать ошибку записи, результат которой никто не ждёт"""
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Ошибка отложенной записи в БД: {future.exception()}")
+
+
+async def _commit_batch(batch: List[Tuple[WriteOp, asyncio.Future]]):
+    """Выполнить пачку операций в одной транзакции"""
+    outcomes = []
+    try:
+        async with _connection() as db:
+            await db.execute('BEGIN IMMEDIATE')
+            for op, _ in batch:
+                await db.execute('SAVEPOINT write_op')
+                try:
+                    outcomes.append((await op(db), None))
+                    await db.execute('RELEASE write_op')
+                except Exception as e:
+                    await db.execute('ROLLBACK TO write_op')
+                    await db.execute('RELEASE write_op')
+                    outcomes.append((None, e))
+            await db.commit()
+    except Exception as e:
+        outcomes = [(None, e)] * len(batch)
+
+    for (_, future), (result, error) in zip(batch, outcomes):
+        if future.done():
+            continue
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+async def _writer_loop():
+    """Собирать операции в пачки и фиксировать их"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _write_queue.get()]
+        deadline = loop.time() + DB_WRITE_BATCH_MS / 1000
+        while len(batch) < DB_WRITE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_write_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await _commit_batch(batch)
+        finally:
+            for _ in batch:
+                _write_queue.task_done()
+
+
+def submit_write(op: WriteOp, durable: bool = True) -> asyncio.Future:
+    """
+    Поставить операцию записи в очередь групповой фиксации.
+    Возвращает future с результатом операции: await future — дождаться,
+    пока запись будет зафиксирована в БД.
+    """
+    global _write_queue, _writer_task
+    if _write_queue is None:
+        _write_queue = asyncio.Queue()
+    if _writer_task is None or _writer_task.done():
+        _writer_task = asyncio.create_task(_writer_loop())
+
+    future = asyncio.get_running_loop().create_future()
+    if not durable:
+        future.add_done_callback(_log_write_error)
+    _write_queue.put_nowait((op, future))
+    return future
+
+
+def _invalidate_on_commit(future: asyncio.Future, *names: str):
+    """Сбросить группы кэша, когда операция записи будет зафиксирована"""
+    future.add_done_callback(lambda _: invalidate(*names))
+
+
+async def flush_writes():
+    """Дождаться фиксации всех операций, уже стоящих в очереди"""
+    if _write_queue is not None and _writer_task is not None and not _writer_task.done():
+        await _write_queue.join()
+
+
+async def _stop_writer():
+    """Сбросить очередь записи и остановить фоновую задачу"""
+    global _writer_task
+    await flush_writes()
+    if _writer_task is not None:
+        _writer_task.cancel()
+        try:
+            await _writer_task
+        except asyncio.CancelledError:
+            pass
+        _writer_task = None
+
+
+# ===== Материализованные счётчики статистики =====
+#
+# stats_counters: отправлено / отвечено / сумма и число ненулевых времён ответа
+# stats_histogram: число ответов в каждой корзине времени ответа
+# Разрезы (scope, key): global/'' , user/<user_id>, message/<message_index>,
+# category/<категория>, difficulty/<сложность>. Обновляются в той же транзакции,
+# что и запись лога или ответа, и полностью пересчитываются из logs.
+
+# Верхние границы корзин гистограммы времени ответа (сек), последняя корзина — открытая
+RESPONSE_TIME_BUCKETS: Tuple[int, ...] = (
+    5, 10, 15, 20, 30, 45, 60, 75, 90, 105, 120, 150, 180, 210, 240, 270, 300,
+    360, 420, 480, 540, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200,
+)
+
+# Выражения ключа для каждого разреза (l — logs, m — messages)
+_COUNTER_SCOPES: Tuple[Tuple[str, str], ...] = (
+    ('global', "''"),
+    ('user', 'CAST(l.user_id AS TEXT)'),
+    ('message', 'CAST(l.message_index AS TEXT)'),
+    ('category', "COALESCE(m.category, '')"),
+    ('difficulty', "COALESCE(m.difficulty, '')"),
+)
+
+_BUCKET_SQL = 'CASE {} ELSE {} END'.format(
+    ' '.join(
+        f'WHEN l.response_time_sec < {bound} THEN {i}'
+        for i, bound in enumerate(RESPONSE_TIME_BUCKETS)
+    ),
+    len(RESPONSE_TIME_BUCKETS),
+)
+
+
+def response_time_bucket(response_time_sec: int) -> int:
+    """Номер корзины гистограммы для времени ответа"""
+    return bisect.bisect_right(RESPONSE_TIME_BUCKETS, response_time_sec)
+
+
+async def _counter_keys(db: aiosqlite.Connection, user_id: int,
+                        message_index: int) -> List[Tuple[str, str]]:
+    """Все разрезы, в которые попадает лог пользователя по сообщению"""
+    cursor = await db.execute(
+        'SELECT category, difficulty FROM messages WHERE message_index = ?', (message_index,)
+    )
+    row = await cursor.fetchone()
+    category, difficulty = (row[0] or '', row[1] or '') if row else ('', '')
+    return [
+        ('global', ''),
+        ('user', str(user_id)),
+        ('message', str(message_index)),
+        ('category', category),
+        ('difficulty', difficulty),
+    ]
+
+
+async def _bump_counters(db: aiosqlite.Connection, user_id: int, message_index: int,
+                         sent: int = 0, answered: int = 0, response_time_sum: int = 0,
+                         response_time_count: int = 0, bucket: Optional[int] = None):
+    """Прибавить дельты ко всем разрезам лога (без commit)"""
+    keys = await _counter_keys(db, user_id, message_index)
+    await db.executemany('''
+        INSERT INTO stats_counters (scope, key, sent, answered, response_time_sum, response_time_count)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(scope, key) DO UPDATE SET
+            sent = sent + excluded.sent,
+            answered = answered + excluded.answered,
+            response_time_sum = response_time_sum + excluded.response_time_sum,
+            response_time_count = response_time_count + excluded.response_time_count
+    ''', [(scope, key, sent, answered, response_time_sum, response_time_count)
+          for scope, key in keys])
+    if bucket is not None:
+        await db.executemany('''
+            INSERT INTO stats_histogram (scope, key, bucket, count)
+            VALUES (?, ?, ?, 1)
+            ON CONFLICT(scope, key, bucket) DO UPDATE SET count = count + 1
+        ''', [(scope, key, bucket) for scope, key in keys])
+
+
+async def _apply_logs_to_counters(db: aiosqlite.Connection, sign: int,
+                                  where: str = '1', params: tuple = ()):
+    """
+    Прибавить (sign=1) или вычесть (sign=-1) из счётчиков логи, подходящие
+    под условие where — одним агрегирующим запросом на разрез (без commit)
+    """
+    for scope, key_sql in _COUNTER_SCOPES:
+        await db.execute(f'''
+            INSERT INTO stats_counters (scope, key, sent, answered, response_time_sum, response_time_count)
+            SELECT
+                '{scope}', {key_sql},
+                {sign} * COUNT(*),
+                {sign} * COUNT(l.answer_text),
+                {sign} * COALESCE(SUM(NULLIF(l.response_time_sec, 0)), 0),
+                {sign} * COUNT(NULLIF(l.response_time_sec, 0))
+            FROM logs l
+            LEFT JOIN messages m ON m.message_index = l.message_index
+            WHERE {where}
+            GROUP BY 2
+            ON CONFLICT(scope, key) DO UPDATE SET
+                sent = sent + excluded.sent,
+                answered = answered + excluded.answered,
+                response_time_sum = response_time_sum + excluded.response_time_sum,
+                response_time_count = response_time_count + excluded.response_time_count
+        ''', params)
+        await db.execute(f'''
+            INSERT INTO stats_histogram (scope, key, bucket, count)
+            SELECT '{scope}', {key_sql}, {_BUCKET_SQL}, {sign} * COUNT(*)
+            FROM logs l
+            LEFT JOIN messages m ON m.message_index = l.message_index
+            WHERE l.response_time_sec > 0 AND ({where})
+            GROUP BY 2, 3
+            ON CONFLICT(scope, key, bucket) DO UPDATE SET count = count + excluded.count
+        ''', params)
+
+    if sign < 0:
         await db.execute('''
-            CREATE TABLE IF NOT EXISTS logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                message_index INTEGER,
-                message_text TEXT,
-                sent_at TEXT,
-                answer_text TEXT,
-                answered_at TEXT,
-                response_time_sec INTEGER,
-                FOREIGN KEY (user_id) REFERENCES users(user_id),
-                FOREIGN KEY (message_index) REFERENCES messages(message_index)
-            )
+            DELETE FROM stats_counters
+            WHERE sent = 0 AND answered = 0 AND response_time_count = 0
         ''')
-        
-        await db.commit()
-        print("✅ База данных инициализирована")
+        await db.execute('DELETE FROM stats_histogram WHERE count = 0')
+
+
+async def _rebuild_stats_counters(db: aiosqlite.Connection):
+    """Пересчитать все счётчики из logs (без commit)"""
+    await db.execute('DELETE FROM stats_counters')
+    await db.execute('DELETE FROM stats_histogram')
+    await _apply_logs_to_counters(db, 1)
+
+
+# Миграции схемы. Номер версии = позиция в списке + 1,
+# текущая версия хранится в PRAGMA user_version.
+# Уже применённые миграции не менять — только добавлять новые в конец.
+# Шаг миграции — SQL-строка или корутина, получающая соединение.
+MigrationStep = Union[str, Callable[[aiosqlite.Connection], Awaitable[None]]]
+MIGRATIONS: List[List[MigrationStep]] = [
+    # 1. Базовые таблицы
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            is_active INTEGER DEFAULT 0,
+            training_start_time TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_index INTEGER UNIQUE,
+            text TEXT NOT NULL,
+            category TEXT,
+            difficulty TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message_index INTEGER,
+            message_text TEXT,
+            sent_at TEXT,
+            answer_text TEXT,
+            answered_at TEXT,
+            response_time_sec INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (message_index) REFERENCES messages(message_index)
+        )
+        ''',
+    ],
+    # 2. Индексы под горячие запросы по логам и пользователям
+    [
+        # MAX(message_index) и последнее сообщение пользователя
+        'CREATE INDEX IF NOT EXISTS idx_logs_user_message ON logs (user_id, message_index)',
+        # Последний неотвеченный лог пользователя
+        '''
+        CREATE INDEX IF NOT EXISTS idx_logs_user_unanswered
+        ON logs (user_id, sent_at) WHERE answer_text IS NULL
+        ''',
+        # Общая выгрузка логов в хронологическом порядке
+        'CREATE INDEX IF NOT EXISTS idx_logs_sent_at ON logs (sent_at)',
+        # Выборка активных пользователей
+        'CREATE INDEX IF NOT EXISTS idx_users_active ON users (user_id) WHERE is_active = 1',
+    ],
+    # 3. Денормализованный прогресс пользователя (вместо MAX() по логам)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS user_progress (
+            user_id INTEGER PRIMARY KEY,
+            next_index INTEGER NOT NULL DEFAULT 1,
+            last_sent_at TEXT,
+            last_unanswered_log_id INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+        '''
+        INSERT OR REPLACE INTO user_progress (user_id, next_index, last_sent_at, last_unanswered_log_id)
+        SELECT
+            l.user_id,
+            MAX(l.message_index) + 1,
+            (SELECT x.sent_at FROM logs x WHERE x.user_id = l.user_id
+             ORDER BY x.message_index DESC LIMIT 1),
+            (SELECT x.id FROM logs x WHERE x.user_id = l.user_id AND x.answer_text IS NULL
+             ORDER BY x.sent_at DESC LIMIT 1)
+        FROM logs l
+        GROUP BY l.user_id
+        ''',
+    ],
+    # 4. Outbox: очередь исходящих сообщений для диспетчера доставки
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message_index INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            rendered_text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            claimed_at TEXT,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            delivered_at TEXT,
+            log_id INTEGER
+        )
+        ''',
+        # Выборка следующего сообщения для отправки
+        '''
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox (next_attempt_at) WHERE status = 'pending'
+        ''',
+        # Есть ли у пользователя недоставленное сообщение
+        '''
+        CREATE INDEX IF NOT EXISTS idx_outbox_user_open
+        ON outbox (user_id) WHERE status IN ('pending', 'sending')
+        ''',
+    ],
+    # 5. Логи одного пользователя в хронологическом порядке (отчёты, статистика)
+    [
+        'CREATE INDEX IF NOT EXISTS idx_logs_user_sent ON logs (user_id, sent_at)',
+    ],
+    # 6. Материализованные счётчики статистики + заполнение из существующих логов
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            answered INTEGER NOT NULL DEFAULT 0,
+            response_time_sum INTEGER NOT NULL DEFAULT 0,
+            response_time_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, key)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS stats_histogram (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, key, bucket)
+        ) WITHOUT ROWID
+        ''',
+        _rebuild_stats_counters,
+    ],
+    # 7. Аренды (leases): выбор ведущего процесса и владение шардами
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+    ],
+    # 8. Водяные знаки инкрементального экспорта и индекс для выборки по ответам
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS export_watermarks (
+            name TEXT PRIMARY KEY,
+            last_log_id INTEGER NOT NULL DEFAULT 0,
+            last_answered_at TEXT NOT NULL DEFAULT '',
+            exported_at TEXT
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_logs_answered_at
+        ON logs (answered_at) WHERE answered_at IS NOT NULL
+        ''',
+    ],
+    # 9. Кэш готовых файлов экспорта по версии данных
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS export_artifacts (
+            key TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            path TEXT NOT NULL,
+            file_id TEXT,
+            created_at TEXT NOT NULL
+        )
+        ''',
+    ],
+]
+
+
+def _casefold(value: Optional[str]) -> Optional[str]:
+    return value.casefold() if value else value
+
+
+async def _configure_connection(db: aiosqlite.Connection):
+    """Настройки соединения, которые действуют только в рамках сессии"""
+    await db.execute('PRAGMA synchronous = NORMAL')
+    await db.execute(f'PRAGMA cache_size = {-abs(DB_CACHE_SIZE_KB)}')
+    await db.execute('PRAGMA temp_store = MEMORY')
+    # Регистронезависимый поиск по кириллице (встроенные LIKE/lower — только ASCII)
+    await db.create_function('casefold', 1, _casefold, deterministic=True)
+
+
+async def run_migrations(db: aiosqlite.Connection) -> int:
+    """Применить недостающие миграции, вернуть итоговую версию схемы"""
+    cursor = await db.execute('PRAGMA user_version')
+    row = await cursor.fetchone()
+    version = row[0] if row else 0
+
+    for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        await db.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in statements:
+                if callable(statement):
+                    await statement(db)
+                else:
+                    await db.execute(statement)
+            await db.execute(f'PRAGMA user_version = {target}')
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        version = target
+        print(f"✅ Применена миграция БД #{target}")
+
+    return version
+
+
+async def init_db():
+    """Инициализация базы данных - миграции схемы и пул соединений"""
+    await init_pool()
+    async with _connection() as db:
+        # WAL сохраняется в файле БД, достаточно включить один раз
+        await db.execute('PRAGMA journal_mode = WAL')
+        version = await run_migrations(db)
+        print(f"✅ База данных инициализирована (версия схемы {version})")
 
 
 async def load_messages_to_db(messages: List[Dict]):
     """Загрузка сценария сообщений в БД"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _connection() as db:
         # Очистка таблицы сообщений
         await db.execute('DELETE FROM messages')
         
@@ -80,7 +592,7 @@ async def load_messages_to_db(messages: List[Dict]):
 
 async def add_user(user_id: int, username: str, full_name: str):
     """Добавить или обновить пользователя"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _connection() as db:
         await db.execute('''
             INSERT INTO users (user_id, username, full_name, created_at)
             VALUES (?, ?, ?, ?)
@@ -89,11 +601,12 @@ async def add_user(user_id: int, username: str, full_name: str):
                 full_name = excluded.full_name
         ''', (user_id, username, full_name, datetime.now().isoformat()))
         await db.commit()
+    invalidate(USERS, STATS)
 
 
 async def set_user_active(user_id: int, is_active: bool):
     """Установить статус активности пользователя"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _connection() as db:
         training_start = datetime.now().isoformat() if is_active else None
         await db.execute('''
             UPDATE users 
@@ -101,12 +614,12 @@ async def set_user_active(user_id: int, is_active: bool):
             WHERE user_id = ?
         ''', (1 if is_active else 0, training_start, user_id))
         await db.commit()
+    invalidate(USERS, STATS, STATUS)
 
 
 async def get_active_users() -> List[Dict]:
     """Получить всех активных пользователей"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connection() as db:
         cursor = await db.execute('''
             SELECT user_id, username, full_name, training_start_time
             FROM users WHERE is_active = 1
@@ -115,22 +628,51 @@ async def get_active_users() -> List[Dict]:
         return [dict(row) for row in rows]
 
 
-async def get_all_users() -> List[Dict]:
-    """Получить всех пользователей"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute('''
+@cached(USERS)
+async def get_users_page(
+    cursor: int = 0,
+    limit: int = 10,
+    query: Optional[str] = None,
+    backward: bool = False
+) -> Tuple[List[Dict], bool]:
+    """
+    Страница пользователей по keyset-пагинации (по user_id).
+    cursor — user_id, после которого (backward=True — до которого) начинается
+    страница. query — поиск по имени или нику (подстрока, без учёта регистра).
+    Возвращает (пользователи по возрастанию user_id, есть ли ещё страница
+    в направлении листания).
+    """
+    conditions = ['user_id < ?' if backward else 'user_id > ?']
+    params: List[Any] = [cursor]
+    if query:
+        escaped = query.casefold().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        pattern = f'%{escaped}%'
+        conditions.append(
+            "(casefold(full_name) LIKE ? ESCAPE '\\' OR casefold(username) LIKE ? ESCAPE '\\')"
+        )
+        params += [pattern, pattern]
+    params.append(limit + 1)
+
+    async with _connection() as db:
+        sql_cursor = await db.execute(f'''
             SELECT user_id, username, full_name, is_active, training_start_time, created_at
             FROM users
-        ''')
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
+            WHERE {' AND '.join(conditions)}
+            ORDER BY user_id {'DESC' if backward else 'ASC'}
+            LIMIT ?
+        ''', params)
+        rows = [dict(row) for row in await sql_cursor.fetchall()]
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
 
 
 async def get_user(user_id: int) -> Optional[Dict]:
     """Получить пользователя по ID"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connection() as db:
         cursor = await db.execute(
             'SELECT * FROM users WHERE user_id = ?', (user_id,)
         )
@@ -138,92 +680,404 @@ async def get_user(user_id: int) -> Optional[Dict]:
         return dict(row) if row else None
 
 
-# ===== Функции для работы с сообщениями =====
+# ===== Функции для работы с логами =====
 
-async def get_message_by_index(index: int) -> Optional[Dict]:
-    """Получить сообщение по индексу"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            'SELECT * FROM messages WHERE message_index = ?', (index,)
-        )
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+async def _insert_log(db: aiosqlite.Connection, user_id: int, message_index: int,
+                      message_text: str, sent_at: str) -> int:
+    """Вставить запись лога и обновить прогресс пользователя (без commit)"""
+    cursor = await db.execute('''
+        INSERT INTO logs (user_id, message_index, message_text, sent_at)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, message_index, message_text, sent_at))
+    log_id = cursor.lastrowid
+    await db.execute('''
+        INSERT INTO user_progress (user_id, next_index, last_sent_at, last_unanswered_log_id)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            next_index = MAX(next_index, excluded.next_index),
+            last_sent_at = excluded.last_sent_at,
+            last_unanswered_log_id = excluded.last_unanswered_log_id
+    ''', (user_id, message_index + 1, sent_at, log_id))
+    await _bump_counters(db, user_id, message_index, sent=1)
+    return log_id
 
 
-async def get_total_messages() -> int:
-    """Получить общее количество сообщений"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute('SELECT COUNT(*) FROM messages')
+async def get_last_unanswered_log(user_id: int) -> Optional[Dict]:
+    """Получить последний лог без ответа для пользователя"""
+    async with _connection() as db:
+        cursor = await db.execute('''
+            SELECT l.* FROM user_progress p
+            JOIN logs l ON l.id = p.last_unanswered_log_id
+            WHERE p.user_id = ?
+        ''', (user_id,))
         row = await cursor.fetchone()
-        return row[0] if row else 0
+        return dict(row) if row else None
 
 
-async def get_all_messages_from_db() -> List[Dict]:
-    """Получить все сообщения из БД"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+async def save_answer(log_id: int, answer_text: str, answered_at: str, response_time_sec: int,
+                      durable: bool = True) -> Optional[Dict]:
+    """
+    Сохранить ответ пользователя (durable=True — дождаться фиксации).
+    При durable=True возвращает следующий неотвеченный лог ({id, sent_at}) или None.
+    """
+    async def op(db: aiosqlite.Connection) -> Optional[Dict]:
         cursor = await db.execute(
-            'SELECT * FROM messages ORDER BY message_index'
+            'SELECT user_id, message_index, answer_text FROM logs WHERE id = ?', (log_id,)
+        )
+        log = await cursor.fetchone()
+        await db.execute('''
+            UPDATE logs 
+            SET answer_text = ?, answered_at = ?, response_time_sec = ?
+            WHERE id = ?
+        ''', (answer_text, answered_at, response_time_sec, log_id))
+        # Счётчики — только за первый ответ на лог
+        if log is not None and log['answer_text'] is None:
+            timed = response_time_sec > 0
+            await _bump_counters(
+                db, log['user_id'], log['message_index'],
+                answered=1,
+                response_time_sum=response_time_sec if timed else 0,
+                response_time_count=1 if timed else 0,
+                bucket=response_time_bucket(response_time_sec) if timed else None,
+            )
+        if log is None:
+            return None
+        # Следующий неотвеченный лог (если остались старые) — по частичному индексу
+        cursor = await db.execute('''
+            SELECT id, sent_at FROM logs
+            WHERE user_id = ? AND answer_text IS NULL
+            ORDER BY sent_at DESC
+            LIMIT 1
+        ''', (log['user_id'],))
+        next_log = await cursor.fetchone()
+        await db.execute(
+            'UPDATE user_progress SET last_unanswered_log_id = ? WHERE user_id = ?',
+            (next_log['id'] if next_log else None, log['user_id'])
         )
+        return dict(next_log) if next_log else None
+
+    future = submit_write(op, durable)
+    _invalidate_on_commit(future, STATS)
+    return await future if durable else None
+
+
+async def get_all_logs() -> List[Dict]:
+    """Получить все логи"""
+    async with _connection() as db:
+        cursor = await db.execute('''
+            SELECT l.*, u.username, u.full_name
+            FROM logs l
+            LEFT JOIN users u ON l.user_id = u.user_id
+            ORDER BY l.sent_at
+        ''')
         rows = await cursor.fetchall()
         return [dict(row) for row in rows]
 
 
-# ===== Функции для работы с логами =====
+async def iter_all_logs(chunk_size: int = 500) -> AsyncIterator[List[Dict]]:
+    """Выдавать все логи порциями по chunk_size (для потокового экспорта)"""
+    async with _connection() as db:
+        cursor = await db.execute('''
+            SELECT l.*, u.username, u.full_name
+            FROM logs l
+            LEFT JOIN users u ON l.user_id = u.user_id
+            ORDER BY l.sent_at
+        ''')
+        while True:
+            rows = await cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+
+
+async def iter_user_logs(user_id: int, chunk_size: int = 500) -> AsyncIterator[List[Dict]]:
+    """Выдавать логи одного пользователя порциями по chunk_size"""
+    async with _connection() as db:
+        cursor = await db.execute('''
+            SELECT l.*, u.username, u.full_name
+            FROM logs l
+            LEFT JOIN users u ON l.user_id = u.user_id
+            WHERE l.user_id = ?
+            ORDER BY l.sent_at
+        ''', (user_id,))
+        while True:
+            rows = await cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+
 
-async def log_sent_message(user_id: int, message_index: int, message_text: str, sent_at: str):
-    """Записать отправленное сообщение в лог"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+async def iter_logs_by_user(chunk_size: int = 500) -> AsyncIterator[List[Dict]]:
+    """
+    Выдавать все логи порциями, упорядоченными по пользователю и времени
+    отправки (индекс idx_logs_user_sent) — для выгрузки по пользователям
+    за один проход.
+    """
+    async with _connection() as db:
+        cursor = await db.execute('''
+            SELECT l.*, u.username, u.full_name
+            FROM logs l
+            LEFT JOIN users u ON l.user_id = u.user_id
+            ORDER BY l.user_id, l.sent_at
+        ''')
+        while True:
+            rows = await cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+
+
+async def iter_logs_since(last_log_id: int, last_answered_at: str,
+                          chunk_size: int = 500) -> AsyncIterator[List[Dict]]:
+    """
+    Выдавать порциями логи, появившиеся (id > last_log_id) или получившие
+    ответ (answered_at > last_answered_at) после водяного знака.
+    Условия выбираются отдельно (диапазон rowid и idx_logs_answered_at) и
+    объединяются UNION: с OR и ORDER BY SQLite просматривает всю таблицу.
+    """
+    async with _connection() as db:
+        cursor = await db.execute('''
+            WITH changed(id) AS (
+                SELECT id FROM logs WHERE id > ?
+                UNION
+                SELECT id FROM logs WHERE answered_at > ?
+            )
+            SELECT l.*, u.username, u.full_name
+            FROM changed c
+            JOIN logs l ON l.id = c.id
+            LEFT JOIN users u ON l.user_id = u.user_id
+            ORDER BY c.id
+        ''', (last_log_id, last_answered_at))
+        while True:
+            rows = await cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+
+
+async def get_export_watermark(name: str) -> Dict:
+    """Водяной знак экспорта: последний выгруженный id лога и время ответа"""
+    async with _connection() as db:
+        cursor = await db.execute(
+            'SELECT last_log_id, last_answered_at, exported_at FROM export_watermarks WHERE name = ?',
+            (name,)
+        )
+        row = await cursor.fetchone()
+        if row is None:
+            return {"last_log_id": 0, "last_answered_at": "", "exported_at": None}
+        return dict(row)
+
+
+async def set_export_watermark(name: str, last_log_id: int, last_answered_at: str):
+    """Сохранить водяной знак (не сдвигая его назад)"""
+    async with _connection() as db:
         await db.execute('''
-            INSERT INTO logs (user_id, message_index, message_text, sent_at)
+            INSERT INTO export_watermarks (name, last_log_id, last_answered_at, exported_at)
             VALUES (?, ?, ?, ?)
-        ''', (user_id, message_index, message_text, sent_at))
+            ON CONFLICT(name) DO UPDATE SET
+                last_log_id = MAX(last_log_id, excluded.last_log_id),
+                last_answered_at = MAX(last_answered_at, excluded.last_answered_at),
+                exported_at = excluded.exported_at
+        ''', (name, last_log_id, last_answered_at, datetime.now().isoformat()))
         await db.commit()
 
 
-async def get_last_unanswered_log(user_id: int) -> Optional[Dict]:
-    """Получить последний лог без ответа для пользователя"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute('''
-            SELECT * FROM logs 
-            WHERE user_id = ? AND answer_text IS NULL
-            ORDER BY sent_at DESC
-            LIMIT 1
-        ''', (user_id,))
+async def get_logs_version(user_id: Optional[int] = None) -> Dict:
+    """
+    Версия данных логов (всех или одного пользователя): максимальный id,
+    число логов и ответов, время последнего ответа. Общая версия берётся
+    из счётчиков и индексов, без прохода по логам.
+    """
+    async with _connection() as db:
+        if user_id is None:
+            cursor = await db.execute('''
+                SELECT
+                    (SELECT COALESCE(MAX(id), 0) FROM logs) AS max_id,
+                    (SELECT COALESCE(MAX(answered_at), '') FROM logs
+                     WHERE answered_at IS NOT NULL) AS max_answered_at,
+                    COALESCE((SELECT sent FROM stats_counters
+                              WHERE scope = 'global' AND key = ''), 0) AS sent,
+                    COALESCE((SELECT answered FROM stats_counters
+                              WHERE scope = 'global' AND key = ''), 0) AS answered
+            ''')
+        else:
+            cursor = await db.execute('''
+                SELECT
+                    COALESCE(MAX(id), 0) AS max_id,
+                    COALESCE(MAX(answered_at), '') AS max_answered_at,
+                    COUNT(*) AS sent,
+                    COUNT(answer_text) AS answered
+                FROM logs WHERE user_id = ?
+            ''', (user_id,))
+        return dict(await cursor.fetchone())
+
+
+async def get_export_artifact(key: str) -> Optional[Dict]:
+    """Последний файл экспорта с этим ключом"""
+    async with _connection() as db:
+        cursor = await db.execute(
+            'SELECT key, version, path, file_id, created_at FROM export_artifacts WHERE key = ?',
+            (key,)
+        )
         row = await cursor.fetchone()
         return dict(row) if row else None
 
 
-async def save_answer(log_id: int, answer_text: str, answered_at: str, response_time_sec: int):
-    """Сохранить ответ пользователя"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+async def save_export_artifact(key: str, version: str, path: str):
+    """Запомнить новый файл экспорта (file_id прошлой загрузки сбрасывается)"""
+    async with _connection() as db:
         await db.execute('''
-            UPDATE logs 
-            SET answer_text = ?, answered_at = ?, response_time_sec = ?
-            WHERE id = ?
-        ''', (answer_text, answered_at, response_time_sec, log_id))
+            INSERT INTO export_artifacts (key, version, path, file_id, created_at)
+            VALUES (?, ?, ?, NULL, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                version = excluded.version,
+                path = excluded.path,
+                file_id = NULL,
+                created_at = excluded.created_at
+        ''', (key, version, path, datetime.now().isoformat()))
         await db.commit()
 
 
-async def get_all_logs() -> List[Dict]:
-    """Получить все логи"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        db.row_factory = aiosqlite.Row
+async def set_export_file_id(key: str, version: str, file_id: str):
+    """Запомнить file_id загруженного в Telegram файла (если версия не сменилась)"""
+    async with _connection() as db:
+        await db.execute(
+            'UPDATE export_artifacts SET file_id = ? WHERE key = ? AND version = ?',
+            (file_id, key, version)
+        )
+        await db.commit()
+
+
+async def delete_export_artifacts(paths: List[str]):
+    """Забыть файлы экспорта, удалённые с диска (без file_id их не переиспользовать)"""
+    if not paths:
+        return
+    async with _connection() as db:
+        await db.executemany(
+            'DELETE FROM export_artifacts WHERE path = ? AND file_id IS NULL',
+            [(path,) for path in paths]
+        )
+        await db.commit()
+
+
+async def get_user_log_stats(user_id: int) -> Dict:
+    """
+    Агрегаты по логам одного пользователя, посчитанные в SQL.
+    Время ответа учитывается только ненулевое (как в отчётах).
+    """
+    async with _connection() as db:
         cursor = await db.execute('''
-            SELECT l.*, u.username, u.full_name
-            FROM logs l
-            LEFT JOIN users u ON l.user_id = u.user_id
-            ORDER BY l.sent_at
+            SELECT
+                COUNT(*) AS total_received,
+                COUNT(answer_text) AS total_answered,
+                COALESCE(SUM(NULLIF(response_time_sec, 0)), 0) AS response_time_sum,
+                COUNT(NULLIF(response_time_sec, 0)) AS response_time_count,
+                COALESCE(MIN(NULLIF(response_time_sec, 0)), 0) AS min_response_time_sec,
+                COALESCE(MAX(NULLIF(response_time_sec, 0)), 0) AS max_response_time_sec
+            FROM logs
+            WHERE user_id = ?
+        ''', (user_id,))
+        row = await cursor.fetchone()
+        return dict(row)
+
+
+# ===== Статистика (чтение материализованных счётчиков) =====
+
+@cached(USERS)
+async def get_user_counts() -> Dict:
+    """Количество пользователей всего и активных"""
+    async with _connection() as db:
+        cursor = await db.execute('''
+            SELECT COUNT(*) AS total_users, COALESCE(SUM(is_active = 1), 0) AS active_users
+            FROM users
+        ''')
+        row = await cursor.fetchone()
+        return dict(row)
+
+
+async def get_stats_counter(scope: str = 'global', key: str = '') -> Dict:
+    """Материализованные счётчики одного разреза (нули, если данных нет)"""
+    async with _connection() as db:
+        cursor = await db.execute('''
+            SELECT sent, answered, response_time_sum, response_time_count
+            FROM stats_counters WHERE scope = ? AND key = ?
+        ''', (scope, key))
+        row = await cursor.fetchone()
+        if row is None:
+            return {"sent": 0, "answered": 0, "response_time_sum": 0, "response_time_count": 0}
+        return dict(row)
+
+
+async def get_stats_counters(scope: str) -> List[Dict]:
+    """Счётчики всех ключей разреза (message, category, difficulty)"""
+    async with _connection() as db:
+        cursor = await db.execute('''
+            SELECT key, sent, answered, response_time_sum, response_time_count
+            FROM stats_counters WHERE scope = ?
+            ORDER BY key
+        ''', (scope,))
+        rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
+
+
+async def get_participants_count() -> int:
+    """Сколько пользователей получили хотя бы одно сообщение"""
+    async with _connection() as db:
+        cursor = await db.execute(
+            "SELECT COUNT(*) FROM stats_counters WHERE scope = 'user' AND sent > 0"
+        )
+        return (await cursor.fetchone())[0]
+
+
+async def get_response_time_histogram(scope: str = 'global', key: str = '') -> Dict[int, int]:
+    """Гистограмма времени ответа разреза: номер корзины -> число ответов"""
+    async with _connection() as db:
+        cursor = await db.execute('''
+            SELECT bucket, count FROM stats_histogram
+            WHERE scope = ? AND key = ? AND count > 0
+            ORDER BY bucket
+        ''', (scope, key))
+        rows = await cursor.fetchall()
+        return {row['bucket']: row['count'] for row in rows}
+
+
+async def get_per_user_counters() -> List[Dict]:
+    """Разбивка по пользователям из счётчиков (без прохода по логам)"""
+    async with _connection() as db:
+        cursor = await db.execute('''
+            SELECT
+                CAST(c.key AS INTEGER) AS user_id,
+                u.username,
+                u.full_name,
+                c.sent AS received,
+                c.answered,
+                c.response_time_sum,
+                c.response_time_count
+            FROM stats_counters c
+            LEFT JOIN users u ON u.user_id = CAST(c.key AS INTEGER)
+            WHERE c.scope = 'user' AND c.sent > 0
+            ORDER BY user_id
         ''')
         rows = await cursor.fetchall()
         return [dict(row) for row in rows]
 
 
+async def rebuild_stats_counters():
+    """
+    Пересчитать счётчики статистики из logs (обслуживание: после ручных
+    правок БД или смены категорий в сценарии)
+    """
+    async with _connection() as db:
+        await db.execute('BEGIN IMMEDIATE')
+        await _rebuild_stats_counters(db)
+        await db.commit()
+    invalidate(STATS)
+    logger.info("Счётчики статистики пересчитаны из логов")
+
+
 async def get_current_message_index() -> int:
     """Получить текущий индекс сообщения (последний отправленный + 1)"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _connection() as db:
         cursor = await db.execute('''
             SELECT MAX(message_index) FROM logs
         ''')
@@ -233,12 +1087,164 @@ async def get_current_message_index() -> int:
         return 1  # Начинаем с первого сообщения
 
 
-async def get_user_last_message_time(user_id: int) -> Optional[datetime]:
-    """Получить время последнего отправленного сообщения для пользователя"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+async def get_due_users(now: datetime, interval_minutes: int, total_messages: int) -> List[Dict]:
+    """
+    Получить активных пользователей, которым пора отправить следующее сообщение,
+    вместе с номером этого сообщения — одним запросом.
+    Текст сообщения берётся из скомпилированного сценария (app.data.scenario).
+    """
+    cutoff = (now - timedelta(minutes=interval_minutes)).isoformat()
+    shard_sql, shard_params = _shard_sql('u.user_id')
+    async with _connection() as db:
+        cursor = await db.execute(f'''
+            SELECT
+                u.user_id,
+                u.username,
+                u.full_name,
+                COALESCE(p.next_index, 1) AS next_index
+            FROM users u
+            LEFT JOIN user_progress p ON p.user_id = u.user_id
+            WHERE u.is_active = 1
+              AND COALESCE(p.next_index, 1) <= ?
+              AND (p.last_sent_at IS NULL OR p.last_sent_at <= ?)
+              AND NOT EXISTS (
+                  SELECT 1 FROM outbox o
+                  WHERE o.user_id = u.user_id AND o.status IN ('pending', 'sending')
+              ){shard_sql}
+            ORDER BY u.user_id
+        ''', (total_messages, cutoff, *shard_params))
+        rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
+
+
+async def get_schedule(total_messages: int, user_ids: Optional[List[int]] = None) -> List[Dict]:
+    """
+    Получить время последней отправки для активных пользователей,
+    у которых ещё остались сообщения (для построения расписания).
+    """
+    query = '''
+        SELECT u.user_id, p.last_sent_at
+        FROM users u
+        LEFT JOIN user_progress p ON p.user_id = u.user_id
+        WHERE u.is_active = 1
+          AND COALESCE(p.next_index, 1) <= ?
+    '''
+    params: List[Any] = [total_messages]
+    shard_sql, shard_params = _shard_sql('u.user_id')
+    query += shard_sql
+    params.extend(shard_params)
+    if user_ids is not None:
+        if not user_ids:
+            return []
+        query += f" AND u.user_id IN ({', '.join('?' for _ in user_ids)})"
+        params.extend(user_ids)
+
+    async with _connection() as db:
+        cursor = await db.execute(query, params)
+        rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
+
+
+async def clear_user_logs(user_id: int):
+    """Очистить логи конкретного пользователя (при перезапуске тренировки)"""
+    async with _connection() as db:
+        await db.execute('BEGIN IMMEDIATE')
+        await _apply_logs_to_counters(db, -1, 'l.user_id = ?', (user_id,))
+        await db.execute('DELETE FROM logs WHERE user_id = ?', (user_id,))
+        await db.execute('DELETE FROM user_progress WHERE user_id = ?', (user_id,))
+        await db.execute('DELETE FROM outbox WHERE user_id = ?', (user_id,))
+        await db.commit()
+    clear_cache()
+
+
+async def reset_training():
+    """Сбросить всю тренировку"""
+    async with _connection() as db:
+        # Деактивировать всех пользователей
+        await db.execute('UPDATE users SET is_active = 0, training_start_time = NULL')
+        # Очистить логи и прогресс
+        await db.execute('DELETE FROM logs')
+        await db.execute('DELETE FROM user_progress')
+        await db.execute('DELETE FROM outbox')
+        await db.execute('DELETE FROM stats_counters')
+        await db.execute('DELETE FROM stats_histogram')
+        await db.execute('DELETE FROM export_watermarks')
+        await db.execute('DELETE FROM export_artifacts')
+        await db.commit()
+    clear_cache()
+    print("✅ Тренировка сброшена")
+
+
+# ===== Outbox: очередь исходящих сообщений =====
+
+async def enqueue_messages(items: List[Dict], scheduled_at: str) -> List[Optional[int]]:
+    """
+    Поставить сообщения в outbox и продвинуть прогресс пользователей
+    в одной транзакции. items: user_id, message_index, message_text, rendered_text.
+
+    Прогресс продвигается compare-and-set: только если пользователь всё ещё
+    ждёт именно message_index. Иначе сообщение уже поставил другой запуск
+    рассылки (в этом или другом процессе) — оно пропускается.
+    Возвращает id строк outbox по порядку items (None — пропущено).
+    """
+    outbox_ids: List[Optional[int]] = []
+    async with _connection() as db:
+        await db.execute('BEGIN IMMEDIATE')
+        for item in items:
+            user_id, index = item['user_id'], item['message_index']
+            cursor = await db.execute('''
+                UPDATE user_progress SET next_index = ?, last_sent_at = ?
+                WHERE user_id = ? AND next_index = ?
+            ''', (index + 1, scheduled_at, user_id, index))
+            advanced = cursor.rowcount == 1
+            if not advanced and index == 1:
+                # Строки прогресса ещё нет — пользователь ждёт первое сообщение
+                cursor = await db.execute('''
+                    INSERT OR IGNORE INTO user_progress (user_id, next_index, last_sent_at)
+                    VALUES (?, ?, ?)
+                ''', (user_id, index + 1, scheduled_at))
+                advanced = cursor.rowcount == 1
+            if not advanced:
+                outbox_ids.append(None)
+                continue
+            cursor = await db.execute('''
+                INSERT INTO outbox (user_id, message_index, message_text, rendered_text,
+                                    next_attempt_at, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, index, item['message_text'],
+                  item['rendered_text'], scheduled_at, scheduled_at))
+            outbox_ids.append(cursor.lastrowid)
+        await db.commit()
+    return outbox_ids
+
+
+async def claim_outbox_message(now: str) -> Optional[Dict]:
+    """Забрать следующее готовое к отправке сообщение (pending -> sending)"""
+    shard_sql, shard_params = _shard_sql('user_id')
+    async with _connection() as db:
+        cursor = await db.execute(f'''
+            UPDATE outbox
+            SET status = 'sending', attempts = attempts + 1, claimed_at = ?
+            WHERE id = (
+                SELECT id FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ?{shard_sql}
+                ORDER BY next_attempt_at, id
+                LIMIT 1
+            )
+            RETURNING *
+        ''', (now, now, *shard_params))
+        row = await cursor.fetchone()
+        await db.commit()
+        return dict(row) if row else None
+
+
+async def get_next_outbox_attempt() -> Optional[datetime]:
+    """Время ближайшей запланированной попытки отправки"""
+    shard_sql, shard_params = _shard_sql('user_id')
+    async with _connection() as db:
         cursor = await db.execute(
-            'SELECT sent_at FROM logs WHERE user_id = ? ORDER BY message_index DESC LIMIT 1',
-            (user_id,)
+            f"SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'{shard_sql}",
+            shard_params
         )
         row = await cursor.fetchone()
         if row and row[0]:
@@ -246,29 +1252,120 @@ async def get_user_last_message_time(user_id: int) -> Optional[datetime]:
         return None
 
 
-async def get_user_next_message_index(user_id: int) -> int:
-    """Получить следующий индекс сообщения для конкретного пользователя"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+def submit_outbox_delivered(outbox_id: int, sent_at: str, durable: bool = False) -> asyncio.Future:
+    """
+    Поставить отметку о доставке в групповой коммит, не дожидаясь его.
+    Future разрешится id записи лога (None, если сообщение уже не в sending).
+    """
+    async def op(db: aiosqlite.Connection) -> Optional[int]:
         cursor = await db.execute(
-            'SELECT MAX(message_index) FROM logs WHERE user_id = ?', (user_id,)
+            "SELECT * FROM outbox WHERE id = ? AND status = 'sending'", (outbox_id,)
         )
         row = await cursor.fetchone()
-        return (row[0] + 1) if row and row[0] else 1
+        if not row:
+            return None
+        log_id = await _insert_log(
+            db, row['user_id'], row['message_index'], row['message_text'], sent_at
+        )
+        await db.execute('''
+            UPDATE outbox SET status = 'delivered', delivered_at = ?, log_id = ?
+            WHERE id = ?
+        ''', (sent_at, log_id, outbox_id))
+        return log_id
 
+    future = submit_write(op, durable)
+    _invalidate_on_commit(future, STATS, STATUS)
+    return future
 
-async def clear_user_logs(user_id: int):
-    """Очистить логи конкретного пользователя (при перезапуске тренировки)"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute('DELETE FROM logs WHERE user_id = ?', (user_id,))
+
+async def retry_outbox_message(outbox_id: int, next_attempt_at: str, error: str):
+    """Вернуть сообщение в очередь для повторной попытки"""
+    async with _connection() as db:
+        await db.execute('''
+            UPDATE outbox SET status = 'pending', next_attempt_at = ?, last_error = ?
+            WHERE id = ? AND status = 'sending'
+        ''', (next_attempt_at, error, outbox_id))
         await db.commit()
 
 
-async def reset_training():
-    """Сбросить всю тренировку"""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        # Деактивировать всех пользователей
-        await db.execute('UPDATE users SET is_active = 0, training_start_time = NULL')
-        # Очистить логи
-        await db.execute('DELETE FROM logs')
+async def mark_outbox_dead(outbox_id: int, error: str):
+    """Перевести сообщение в dead-letter (попытки исчерпаны или ошибка неустранима)"""
+    async with _connection() as db:
+        await db.execute('''
+            UPDATE outbox SET status = 'dead', last_error = ?
+            WHERE id = ? AND status = 'sending'
+        ''', (error, outbox_id))
+        await db.commit()
+
+
+async def get_outbox_statuses(outbox_ids: List[int]) -> Dict[int, str]:
+    """Статусы строк outbox по id (удалённых строк в результате нет)"""
+    statuses: Dict[int, str] = {}
+    ids = list(outbox_ids)
+    async with _connection() as db:
+        # Порциями — у SQLite ограничено число параметров запроса
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor = await db.execute(
+                f"SELECT id, status FROM outbox WHERE id IN ({', '.join('?' for _ in chunk)})",
+                chunk
+            )
+            for row in await cursor.fetchall():
+                statuses[row['id']] = row['status']
+    return statuses
+
+
+async def recover_outbox() -> int:
+    """
+    Разобрать сообщения, застрявшие в статусе sending после падения процесса.
+    Запрос в Telegram мог уже уйти, поэтому считаем их доставленными
+    (at-most-once) — повторная отправка дала бы пользователю дубль.
+    """
+    shard_sql, shard_params = _shard_sql('user_id')
+    async with _connection() as db:
+        cursor = await db.execute(
+            f"SELECT * FROM outbox WHERE status = 'sending'{shard_sql} ORDER BY id",
+            shard_params
+        )
+        rows = await cursor.fetchall()
+        for row in rows:
+            sent_at = row['claimed_at'] or row['created_at']
+            log_id = await _insert_log(
+                db, row['user_id'], row['message_index'], row['message_text'], sent_at
+            )
+            await db.execute('''
+                UPDATE outbox SET status = 'delivered', delivered_at = ?, log_id = ?,
+                                  last_error = 'recovered after restart'
+                WHERE id = ?
+            ''', (sent_at, log_id, row['id']))
+        await db.commit()
+        return len(rows)
+
+
+# ===== Аренды (leases) =====
+
+async def acquire_lease(name: str, owner: str, ttl_sec: float) -> bool:
+    """
+    Взять или продлить аренду name на ttl_sec секунд.
+    Удаётся, если аренда свободна, истекла или уже принадлежит owner.
+    """
+    now = time.time()
+    async with _connection() as db:
+        await db.execute('''
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                owner = excluded.owner,
+                expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+        ''', (name, owner, now + ttl_sec, now))
+        await db.commit()
+        cursor = await db.execute('SELECT owner FROM leases WHERE name = ?', (name,))
+        row = await cursor.fetchone()
+        return row is not None and row['owner'] == owner
+
+
+async def release_lease(name: str, owner: str):
+    """Освободить аренду (только свою)"""
+    async with _connection() as db:
+        await db.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
         await db.commit()
-        print("✅ Тренировка сброшена")
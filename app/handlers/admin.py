@@ -1,22 +1,71 @@
 """
 Админские команды
 """
+from typing import Dict, List, NamedTuple, Optional
+
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
 
 from app.config import ADMIN_ID
-from app.db import get_all_users, reset_training, get_all_logs, get_user
-from app.services.export import export_logs_to_csv, export_user_report
+from app.db import (
+    get_users_page,
+    get_user_counts,
+    reset_training,
+    get_user,
+    rebuild_stats_counters,
+)
+from app.services.export import (
+    ExportFile,
+    export_logs,
+    commit_export_watermark,
+    get_user_report,
+    get_users_bundle,
+    remember_file_id,
+    export_input_file,
+    close_export,
+)
+from app.services.statistics import (
+    get_training_statistics,
+    format_statistics_text,
+    format_duration,
+)
+from app.scheduler import clear_schedule
+from app.services.sessions import clear_sessions
+from app.services.jobs import start_send_job, get_job
+from app.sharding import broadcast
 
 router = Router()
 
+# Пользователей на одной странице списка / клавиатуры экспорта
+USERS_PAGE_SIZE = 10
+
+# Сколько пользователей показывать в разбивке /stats (сообщение ограничено 4096 символами)
+STATS_USERS_LIMIT = 20
+
+# Списки пользователей: клавиатура экспорта и /users
+VIEW_EXPORT = "exp"
+VIEW_USERS = "usr"
+
+# Текущий поиск по пользователям для каждого списка (админ один)
+_search_queries: Dict[str, str] = {}
+
 
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь админом"""
     return user_id == ADMIN_ID
 
 
+async def send_export(message: Message, export: ExportFile, caption: str):
+    """Отправить файл экспорта (с диска, из памяти или по file_id) и запомнить file_id"""
+    try:
+        sent = await message.answer_document(document=export_input_file(export), caption=caption)
+    finally:
+        await close_export(export)
+    if sent.document:
+        await remember_file_id(export, sent.document.file_id)
+
+
 def get_admin_keyboard():
     """Создать админскую клавиатуру"""
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -29,17 +78,58 @@ def get_admin_keyboard():
     return keyboard
 
 
-async def get_export_keyboard():
-    """Создать клавиатуру для экспорта"""
-    users = await get_all_users()
-    
+class UsersPage(NamedTuple):
+    """Страница пользователей и наличие соседних страниц"""
+    users: List[Dict]
+    has_prev: bool
+    has_next: bool
+    query: Optional[str]
+
+
+async def load_users_page(view: str, cursor: int = 0, backward: bool = False) -> UsersPage:
+    """
+    Загрузить страницу списка одним запросом. Наличие страницы с другой
+    стороны известно из направления листания: раз пришли оттуда — она есть.
+    """
+    query = _search_queries.get(view)
+    users, has_more = await get_users_page(cursor, USERS_PAGE_SIZE, query, backward)
+    if backward:
+        return UsersPage(users, has_more, True, query)
+    return UsersPage(users, cursor > 0, has_more, query)
+
+
+def get_page_navigation(view: str, page: UsersPage) -> List[List[InlineKeyboardButton]]:
+    """Кнопки листания и сброса поиска"""
+    rows = []
+    nav = []
+    if page.has_prev and page.users:
+        nav.append(InlineKeyboardButton(
+            text="⬅️", callback_data=f"users_page:{view}:prev:{page.users[0]['user_id']}"
+        ))
+    if page.has_next and page.users:
+        nav.append(InlineKeyboardButton(
+            text="➡️", callback_data=f"users_page:{view}:next:{page.users[-1]['user_id']}"
+        ))
+    if nav:
+        rows.append(nav)
+    if page.query:
+        rows.append([InlineKeyboardButton(
+            text="✖️ Сбросить поиск", callback_data=f"users_page:{view}:reset:0"
+        )])
+    return rows
+
+
+def get_export_keyboard(page: UsersPage):
+    """Создать клавиатуру для экспорта (одна страница пользователей)"""
     buttons = []
     
     # Кнопка "Скачать всё"
     buttons.append([InlineKeyboardButton(text="📥 Скачать всё", callback_data="export_all")])
+    buttons.append([InlineKeyboardButton(text="🆕 Новое с прошлого экспорта", callback_data="export_delta")])
+    buttons.append([InlineKeyboardButton(text="🗂 Диалоги всех (ZIP)", callback_data="export_bundle")])
     
-    # Кнопки для каждого пользователя
-    for user in users:
+    # Кнопки для каждого пользователя на странице
+    for user in page.users:
         username = f"@{user['username']}" if user.get('username') else ""
         name = user.get('full_name', 'Пользователь')
         display = f"{name} {username}".strip()
@@ -52,48 +142,145 @@ async def get_export_keyboard():
         ])
     
     # Кнопки навигации
+    buttons.extend(get_page_navigation(VIEW_EXPORT, page))
     buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_back")])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+def escape_markdown(text: str) -> str:
+    """Экранировать пользовательский текст для parse_mode=Markdown"""
+    for char in ('_', '*', '`', '['):
+        text = text.replace(char, f'\\{char}')
+    return text
+
+
+def get_export_text(page: UsersPage) -> str:
+    """Заголовок меню экспорта (бот по умолчанию шлёт текст в Markdown)"""
+    text = "📊 Выберите что экспортировать:"
+    if page.query:
+        text += f"\n🔍 Поиск: {escape_markdown(page.query)}"
+        if not page.users:
+            text += "\n\nНикого не найдено."
+    return text
+
+
+def get_users_text(page: UsersPage, counts: Dict) -> str:
+    """Текст страницы /users"""
+    text = "👥 *Пользователи:*\n\n"
+    if page.query:
+        text += f"🔍 Поиск: {escape_markdown(page.query)}\n\n"
+    if not page.users:
+        text += "Никого не найдено.\n\n"
+    
+    for user in page.users:
+        status = "🟢" if user.get('is_active') else "⚪"
+        username = f"@{user['username']}" if user.get('username') else "—"
+        text += f"{status} {escape_markdown(user['full_name'] or '')} ({escape_markdown(username)})\n"
+        text += f"   ID: `{user['user_id']}`\n\n"
+    
+    text += f"_Всего: {counts['total_users']} | Активных: {counts['active_users']}_"
+    return text
+
+
+def get_stats_users_text(users: List[Dict]) -> str:
+    """Разбивка /stats по пользователям (не больше STATS_USERS_LIMIT строк)"""
+    if not users:
+        return ""
+    lines = []
+    for user in users[:STATS_USERS_LIMIT]:
+        name = escape_markdown(user['full_name'] or str(user['user_id']))
+        lines.append(
+            f"• {name}: {user['answered']}/{user['received']} ({user['answer_rate']}%), "
+            f"⏱ {format_duration(user['avg_response_time_sec'])}"
+        )
+    if len(users) > STATS_USERS_LIMIT:
+        lines.append(f"…и ещё {len(users) - STATS_USERS_LIMIT}")
+    return "\n\n👤 По пользователям:\n" + "\n".join(lines)
+
+
+def get_users_keyboard(page: UsersPage) -> Optional[InlineKeyboardMarkup]:
+    """Клавиатура листания для /users (None, если всё на одной странице)"""
+    rows = get_page_navigation(VIEW_USERS, page)
+    return InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+
+def _set_search(view: str, message_text: str):
+    """Запомнить поиск из аргумента команды (без аргумента — сбросить)"""
+    args = message_text.split(maxsplit=1)
+    if len(args) > 1 and args[1].strip():
+        _search_queries[view] = args[1].strip()
+    else:
+        _search_queries.pop(view, None)
+
+
 @router.message(Command("export"))
 async def cmd_export(message: Message):
-    """Экспорт логов в CSV - показать меню выбора"""
+    """Экспорт логов в CSV - показать меню выбора (/export <текст> — поиск)"""
     if not is_admin(message.from_user.id):
         await message.answer("⛔ Эта команда доступна только администратору.")
         return
     
-    users = await get_all_users()
-    if not users:
+    _set_search(VIEW_EXPORT, message.text)
+    page = await load_users_page(VIEW_EXPORT)
+    if not page.users and not page.query:
         await message.answer("👤 Пользователей пока нет.")
         return
     
-    keyboard = await get_export_keyboard()
     await message.answer(
-        "📊 Выберите что экспортировать:",
-        reply_markup=keyboard
+        get_export_text(page),
+        reply_markup=get_export_keyboard(page)
     )
 
 
-@router.callback_query(F.data == "export_all")
+@router.callback_query(F.data.in_({"export_all", "export_delta"}))
 async def callback_export_all(callback: CallbackQuery):
-    """Экспорт всех логов"""
+    """Экспорт всех логов (или только новых с прошлого экспорта)"""
     if not is_admin(callback.from_user.id):
         await callback.answer("⛔ Нет доступа", show_alert=True)
         return
     
-    await callback.message.edit_text("📊 Формирую полный отчёт...")
+    delta = callback.data == "export_delta"
+    await callback.message.edit_text(
+        "📊 Формирую отчёт по новым данным..." if delta else "📊 Формирую полный отчёт..."
+    )
     
     try:
-        file_path = await export_logs_to_csv()
+        export = await export_logs(delta=delta)
         
-        if file_path:
-            document = FSInputFile(file_path)
-            await callback.message.answer_document(
-                document=document,
-                caption="📊 Экспорт всех результатов тренировки"
+        if export.has_data:
+            caption = (
+                f"🆕 Новое с прошлого экспорта: {export.count} записей" if delta
+                else "📊 Экспорт всех результатов тренировки"
             )
+            await send_export(callback.message, export, caption)
+            await commit_export_watermark(export)
+            await callback.message.delete()
+        elif delta:
+            await callback.message.edit_text("📭 Нет новых данных с прошлого экспорта.")
+        else:
+            await callback.message.edit_text("📭 Нет данных для экспорта.")
+            
+    except Exception as e:
+        await callback.message.edit_text(f"❌ Ошибка экспорта: {e}")
+    
+    await callback.answer()
+
+
+@router.callback_query(F.data == "export_bundle")
+async def callback_export_bundle(callback: CallbackQuery):
+    """Экспорт диалогов всех пользователей одним архивом"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ Нет доступа", show_alert=True)
+        return
+    
+    await callback.message.edit_text("🗂 Формирую архив диалогов...")
+    
+    try:
+        export = await get_users_bundle()
+        
+        if export.has_data:
+            await send_export(callback.message, export, "🗂 Диалоги всех пользователей")
             await callback.message.delete()
         else:
             await callback.message.edit_text("📭 Нет данных для экспорта.")
@@ -122,19 +309,14 @@ async def callback_export_user(callback: CallbackQuery):
     await callback.message.edit_text(f"📊 Формирую отчёт для {user.get('full_name', 'пользователя')}...")
     
     try:
-        file_path = await export_user_report(
+        export = await get_user_report(
             user_id=user_id,
-            username=user.get('username', ''),
-            full_name=user.get('full_name', '')
+            username=user.get('username', '')
         )
         
-        if file_path:
-            document = FSInputFile(file_path)
+        if export.has_data:
             name = user.get('full_name', '')
-            await callback.message.answer_document(
-                document=document,
-                caption=f"📊 Диалог с {name}"
-            )
+            await send_export(callback.message, export, f"📊 Диалог с {name}")
             await callback.message.delete()
         else:
             await callback.message.edit_text(f"📭 Нет данных для этого пользователя.")
@@ -174,20 +356,47 @@ async def callback_admin_export(callback: CallbackQuery):
         await callback.answer("⛔ Нет доступа", show_alert=True)
         return
     
-    users = await get_all_users()
-    if not users:
+    _search_queries.pop(VIEW_EXPORT, None)
+    page = await load_users_page(VIEW_EXPORT)
+    if not page.users:
         await callback.message.edit_text("👤 Пользователей пока нет.")
         await callback.answer()
         return
     
-    keyboard = await get_export_keyboard()
     await callback.message.edit_text(
-        "📊 Выберите что экспортировать:",
-        reply_markup=keyboard
+        get_export_text(page),
+        reply_markup=get_export_keyboard(page)
     )
     await callback.answer()
 
 
+@router.callback_query(F.data.startswith("users_page:"))
+async def callback_users_page(callback: CallbackQuery):
+    """Листание списков пользователей и сброс поиска"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ Нет доступа", show_alert=True)
+        return
+    
+    _, view, action, cursor = callback.data.split(":")
+    if action == "reset":
+        _search_queries.pop(view, None)
+    page = await load_users_page(view, int(cursor) if action != "reset" else 0, action == "prev")
+    
+    if view == VIEW_EXPORT:
+        await callback.message.edit_text(
+            get_export_text(page),
+            reply_markup=get_export_keyboard(page)
+        )
+    else:
+        counts = await get_user_counts()
+        await callback.message.edit_text(
+            get_users_text(page, counts),
+            reply_markup=get_users_keyboard(page),
+            parse_mode="Markdown"
+        )
+    await callback.answer()
+
+
 @router.callback_query(F.data == "admin_stats")
 async def callback_admin_stats(callback: CallbackQuery):
     """Показать статистику"""
@@ -195,29 +404,8 @@ async def callback_admin_stats(callback: CallbackQuery):
         await callback.answer("⛔ Нет доступа", show_alert=True)
         return
     
-    logs = await get_all_logs()
-    users = await get_all_users()
-    
-    total_sent = len(logs)
-    total_answered = sum(1 for log in logs if log.get('answer_text'))
-    
-    response_times = [log['response_time_sec'] for log in logs if log.get('response_time_sec')]
-    avg_time = sum(response_times) // len(response_times) if response_times else 0
-    
-    if avg_time < 60:
-        avg_time_str = f"{avg_time} сек"
-    else:
-        avg_time_str = f"{avg_time // 60} мин {avg_time % 60} сек"
-    
-    text = (
-        "📊 Статистика тренировки:\n\n"
-        f"👥 Пользователей: {len(users)}\n"
-        f"🟢 Активных: {sum(1 for u in users if u.get('is_active'))}\n\n"
-        f"📨 Отправлено сообщений: {total_sent}\n"
-        f"✅ Получено ответов: {total_answered}\n"
-        f"📝 Без ответа: {total_sent - total_answered}\n\n"
-        f"⏱ Среднее время ответа: {avg_time_str}"
-    )
+    stats = await get_training_statistics()
+    text = format_statistics_text(stats)
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_back")]
@@ -234,17 +422,29 @@ async def callback_admin_send_now(callback: CallbackQuery):
         await callback.answer("⛔ Нет доступа", show_alert=True)
         return
     
-    from app.scheduler import send_training_messages
+    job, created = start_send_job(callback.bot)
+    if created:
+        broadcast("send_now")
     
-    await callback.message.edit_text("📤 Отправляю сообщение...")
-    await send_training_messages()
+    await callback.message.edit_text(job.text(), reply_markup=job.keyboard())
+    job.attach(callback.message.chat.id, callback.message.message_id)
+    await callback.answer("📤 Рассылка запущена" if created else "⏳ Рассылка уже идёт")
+
+
+@router.callback_query(F.data.startswith("job_cancel:"))
+async def callback_job_cancel(callback: CallbackQuery):
+    """Отменить ручную рассылку"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ Нет доступа", show_alert=True)
+        return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_back")]
-    ])
+    job = get_job(int(callback.data.split(":")[1]))
+    if job is None or job.finished:
+        await callback.answer("Рассылка уже завершена")
+        return
     
-    await callback.message.edit_text("✅ Сообщение отправлено!", reply_markup=keyboard)
-    await callback.answer()
+    job.cancel()
+    await callback.answer("⏹ Рассылка отменена")
 
 
 @router.callback_query(F.data == "admin_reset")
@@ -278,6 +478,9 @@ async def callback_admin_reset_confirm(callback: CallbackQuery):
         return
     
     await reset_training()
+    clear_schedule()
+    clear_sessions()
+    broadcast("reset")
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_back")]
@@ -324,22 +527,18 @@ async def cmd_export_user(message: Message):
     # Получаем аргумент команды (user_id)
     args = message.text.split()
     if len(args) < 2:
-        # Показываем список пользователей для выбора
-        users = await get_all_users()
-        if not users:
+        # Показываем меню выбора пользователя (постранично)
+        _search_queries.pop(VIEW_EXPORT, None)
+        page = await load_users_page(VIEW_EXPORT)
+        if not page.users:
             await message.answer("👤 Пользователей пока нет.")
             return
         
-        text = "📤 Экспорт по пользователю\n\n"
-        text += "Используйте: /export_user <ID>\n\n"
-        text += "Доступные пользователи:\n"
-        
-        for user in users:
-            username = f"@{user['username']}" if user.get('username') else "—"
-            text += f"• {user['full_name']} ({username})\n"
-            text += f"  ID: {user['user_id']}\n"
-        
-        await message.answer(text)
+        await message.answer(
+            "📤 Экспорт по пользователю\n\n"
+            "Используйте: /export_user <ID> или выберите пользователя:",
+            reply_markup=get_export_keyboard(page)
+        )
         return
     
     try:
@@ -357,20 +556,16 @@ async def cmd_export_user(message: Message):
     await message.answer(f"📊 Формирую отчёт для {user.get('full_name', 'пользователя')}...")
     
     try:
-        file_path = await export_user_report(
+        export = await get_user_report(
             user_id=user_id,
-            username=user.get('username', ''),
-            full_name=user.get('full_name', '')
+            username=user.get('username', '')
         )
         
-        if file_path:
-            from aiogram.types import FSInputFile
-            document = FSInputFile(file_path)
-            
+        if export.has_data:
             username_display = f"@{user['username']}" if user.get('username') else str(user_id)
-            await message.answer_document(
-                document=document,
-                caption=f"📊 Диалог с {user.get('full_name', '')} ({username_display})"
+            await send_export(
+                message, export,
+                f"📊 Диалог с {user.get('full_name', '')} ({username_display})"
             )
         else:
             await message.answer(f"📭 Нет данных для пользователя {user_id}.")
@@ -387,6 +582,9 @@ async def cmd_reset(message: Message):
         return
     
     await reset_training()
+    clear_schedule()
+    clear_sessions()
+    broadcast("reset")
     await message.answer(
         "🔄 *Тренировка сброшена!*\n\n"
         "• Все пользователи деактивированы\n"
@@ -398,29 +596,24 @@ async def cmd_reset(message: Message):
 
 @router.message(Command("users"))
 async def cmd_users(message: Message):
-    """Список пользователей"""
+    """Список пользователей (постранично, /users <текст> — поиск)"""
     if not is_admin(message.from_user.id):
         await message.answer("⛔ Эта команда доступна только администратору.")
         return
     
-    users = await get_all_users()
+    _set_search(VIEW_USERS, message.text)
+    page = await load_users_page(VIEW_USERS)
     
-    if not users:
+    if not page.users and not page.query:
         await message.answer("👤 Пользователей пока нет.")
         return
     
-    text = "👥 *Пользователи:*\n\n"
-    
-    for user in users:
-        status = "🟢" if user.get('is_active') else "⚪"
-        username = f"@{user['username']}" if user.get('username') else "—"
-        text += f"{status} {user['full_name']} ({username})\n"
-        text += f"   ID: `{user['user_id']}`\n\n"
-    
-    active_count = sum(1 for u in users if u.get('is_active'))
-    text += f"_Всего: {len(users)} | Активных: {active_count}_"
-    
-    await message.answer(text, parse_mode="Markdown")
+    counts = await get_user_counts()
+    await message.answer(
+        get_users_text(page, counts),
+        reply_markup=get_users_keyboard(page),
+        parse_mode="Markdown"
+    )
 
 
 @router.message(Command("stats"))
@@ -430,34 +623,24 @@ async def cmd_stats(message: Message):
         await message.answer("⛔ Эта команда доступна только администратору.")
         return
     
-    logs = await get_all_logs()
-    users = await get_all_users()
-    
-    total_sent = len(logs)
-    total_answered = sum(1 for log in logs if log.get('answer_text'))
-    
-    # Среднее время ответа
-    response_times = [log['response_time_sec'] for log in logs if log.get('response_time_sec')]
-    avg_time = sum(response_times) // len(response_times) if response_times else 0
-    
-    if avg_time < 60:
-        avg_time_str = f"{avg_time} сек"
-    else:
-        avg_time_str = f"{avg_time // 60} мин {avg_time % 60} сек"
-    
-    text = (
-        "📊 *Статистика тренировки:*\n\n"
-        f"👥 Пользователей: {len(users)}\n"
-        f"🟢 Активных: {sum(1 for u in users if u.get('is_active'))}\n\n"
-        f"📨 Отправлено сообщений: {total_sent}\n"
-        f"✅ Получено ответов: {total_answered}\n"
-        f"📝 Без ответа: {total_sent - total_answered}\n\n"
-        f"⏱ Среднее время ответа: {avg_time_str}"
-    )
+    stats = await get_training_statistics(per_user=True, by_category=True)
+    text = format_statistics_text(stats, markdown=True) + get_stats_users_text(stats['users'])
     
     await message.answer(text, parse_mode="Markdown")
 
 
+@router.message(Command("rebuild_stats"))
+async def cmd_rebuild_stats(message: Message):
+    """Пересчитать счётчики статистики из логов"""
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔ Эта команда доступна только администратору.")
+        return
+    
+    await message.answer("🔄 Пересчитываю статистику...")
+    await rebuild_stats_counters()
+    await message.answer("✅ Счётчики статистики пересчитаны")
+
+
 @router.message(Command("send_now"))
 async def cmd_send_now(message: Message):
     """Отправить сообщение прямо сейчас (для тестирования)"""
@@ -465,11 +648,12 @@ async def cmd_send_now(message: Message):
         await message.answer("⛔ Эта команда доступна только администратору.")
         return
     
-    from app.scheduler import send_training_messages
+    job, created = start_send_job(message.bot)
+    if created:
+        broadcast("send_now")
     
-    await message.answer("📤 Отправляю сообщение...")
-    await send_training_messages()
-    await message.answer("✅ Готово!")
+    status = await message.answer(job.text(), reply_markup=job.keyboard())
+    job.attach(status.chat.id, status.message_id)
 
 
 @router.message(Command("help"))
@@ -486,12 +670,13 @@ async def cmd_help(message: Message):
     
     await message.answer(
         "🔧 *Админ-команды:*\n\n"
-        "/export - Экспорт всех логов в CSV\n"
-        "/export\_user - Экспорт диалога с пользователем\n"
+        "/export \\[текст] - Экспорт логов в CSV (с поиском пользователя)\n"
+        "/export\\_user - Экспорт диалога с пользователем\n"
         "/reset - Сброс тренировки\n"
-        "/users - Список пользователей\n"
+        "/users \\[текст] - Список пользователей (с поиском)\n"
         "/stats - Статистика\n"
-        "/send\_now - Отправить сообщение сейчас\n"
+        "/rebuild\\_stats - Пересчитать статистику из логов\n"
+        "/send\\_now - Отправить сообщение сейчас\n"
         "/help - Это сообщение",
         parse_mode="Markdown"
     )
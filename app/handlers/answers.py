@@ -5,7 +5,8 @@ from datetime import datetime
 from aiogram import Router, F
 from aiogram.types import Message
 
-from app.db import get_user, get_last_unanswered_log, save_answer
+from app.db import save_answer
+from app.services.sessions import get_session, get_open_log, on_answered
 
 router = Router()
 
@@ -24,19 +25,19 @@ async def handle_user_answer(message: Message):
     if answer_text in ["▶️ Начать тренировку", "📄 Скрипты", "⛔ Завершить"]:
         return
     
-    # Проверяем, активна ли тренировка у пользователя
-    user = await get_user(user_id)
-    if not user or not user.get('is_active'):
+    # Проверяем, активна ли тренировка у пользователя (сессия в памяти)
+    session = await get_session(user_id)
+    if not session or not session.is_active:
         await message.answer(
             "ℹ️ Сначала начни тренировку!\n"
             "Нажми «▶️ Начать тренировку»"
         )
         return
     
-    # Ищем последний неотвеченный вопрос
-    last_log = await get_last_unanswered_log(user_id)
+    # Последний неотвеченный вопрос
+    open_log = await get_open_log(session)
     
-    if not last_log:
+    if not open_log:
         await message.answer(
             "⏳ Пока нет новых сообщений для ответа.\n"
             "Жди следующего сообщения от «клиента»!"
@@ -44,17 +45,19 @@ async def handle_user_answer(message: Message):
         return
     
     # Вычисляем время ответа
-    sent_at = datetime.fromisoformat(last_log['sent_at'])
+    log_id, sent_at_iso = open_log
+    sent_at = datetime.fromisoformat(sent_at_iso)
     answered_at = datetime.now()
     response_time_sec = int((answered_at - sent_at).total_seconds())
     
     # Сохраняем ответ
-    await save_answer(
-        log_id=last_log['id'],
+    next_log = await save_answer(
+        log_id=log_id,
         answer_text=answer_text,
         answered_at=answered_at.isoformat(),
         response_time_sec=response_time_sec
     )
+    on_answered(user_id, log_id, next_log)
     
     # Форматируем время для отображения
     if response_time_sec < 60:
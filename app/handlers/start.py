@@ -6,9 +6,12 @@ from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.filters import Command
 
 from app.db import (
-    add_user, set_user_active, get_user, get_all_messages_from_db,
+    add_user, set_user_active,
     clear_user_logs
 )
+from app.data.scenario import get_scenario
+from app.scheduler import schedule_user, unschedule_user, user_lock
+from app.services.sessions import get_session, start_session, stop_session
 
 router = Router()
 
@@ -63,8 +66,8 @@ async def start_training(message: Message):
     user_id = message.from_user.id
     
     # Проверяем, не активна ли уже тренировка
-    user = await get_user(user_id)
-    if user and user.get('is_active'):
+    session = await get_session(user_id)
+    if session and session.is_active:
         await message.answer(
             "⚠️ Тренировка уже активна!\n"
             "Сообщения будут приходить автоматически.\n\n"
@@ -73,8 +76,12 @@ async def start_training(message: Message):
         return
     
     # Сбрасываем личные логи пользователя — тренировка начинается с #1
-    await clear_user_logs(user_id)
-    await set_user_active(user_id, True)
+    # (под блокировкой, чтобы рассылка не поставила сообщение посередине)
+    async with user_lock(user_id):
+        await clear_user_logs(user_id)
+        await set_user_active(user_id, True)
+        start_session(user_id)
+        schedule_user(user_id)
 
     await message.answer(
         "✅ *Тренировка началась!*\n\n"
@@ -90,25 +97,14 @@ async def start_training(message: Message):
 @router.message(F.text == "📄 Скрипты")
 async def show_scripts(message: Message):
     """Показать все скрипты/сообщения"""
-    messages = await get_all_messages_from_db()
+    scenario = get_scenario()
     
-    if not messages:
+    if not scenario.total:
         await message.answer("📭 Сценарий пока не загружен.")
         return
     
-    # Формируем список сообщений
-    text = "📄 *Сценарий тренировки:*\n\n"
-    
-    for msg in messages[:10]:  # Показываем первые 10
-        text += f"*{msg['message_index']}.* _{msg.get('category', 'Общее')}_\n"
-        # Обрезаем длинные сообщения
-        preview = msg['text'][:100] + "..." if len(msg['text']) > 100 else msg['text']
-        text += f"{preview}\n\n"
-    
-    if len(messages) > 10:
-        text += f"_...и ещё {len(messages) - 10} сообщений_"
-    
-    await message.answer(text, parse_mode="Markdown")
+    # Превью первых 10 сообщений собрано заранее вместе со сценарием
+    await message.answer(scenario.scripts_preview, parse_mode="Markdown")
 
 
 @router.message(F.text == "⛔ Завершить")
@@ -117,8 +113,8 @@ async def stop_training(message: Message):
     user_id = message.from_user.id
     
     # Проверяем статус
-    user = await get_user(user_id)
-    if not user or not user.get('is_active'):
+    session = await get_session(user_id)
+    if not session or not session.is_active:
         await message.answer(
             "ℹ️ Тренировка не активна.\n"
             "Нажми «▶️ Начать тренировку» для старта."
@@ -126,7 +122,10 @@ async def stop_training(message: Message):
         return
     
     # Деактивируем пользователя
-    await set_user_active(user_id, False)
+    async with user_lock(user_id):
+        await set_user_active(user_id, False)
+        stop_session(user_id)
+        unschedule_user(user_id)
     
     await message.answer(
         "⛔ *Тренировка завершена!*\n\n"
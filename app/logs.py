@@ -0,0 +1,155 @@
+"""
+Настройка логирования.
+
+Обработчики логгеров только кладут записи в очередь (QueueHandler), а запись
+в файл и консоль выполняет фоновый поток (QueueListener) — всплеск логов
+во время большой рассылки не задерживает event loop. Файл ротируется по
+времени (LOG_ROTATE_WHEN) и по размеру (LOG_MAX_MB), старые копии удаляются
+сверх LOG_BACKUP_COUNT. LOG_FORMAT=json пишет по JSON-объекту на строку,
+с полями user_id и message_index, если они переданы через extra, и
+traceback в поле exception.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime
+from typing import Optional
+
+from app.config import (
+    LOG_FILE,
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_MAX_MB,
+    LOG_ROTATE_WHEN,
+    LOG_BACKUP_COUNT,
+)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Поля из extra, которые попадают в JSON
+CONTEXT_FIELDS = ("user_id", "message_index")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.handlers.QueueHandler] = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который передаёт traceback отдельно (в exc_text), а не
+    вклеивает его в сообщение: иначе JSON-формат не отличит его от текста.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # exc_info с объектом traceback нельзя передавать дальше — оставляем текст
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class SizedTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """Ротация по времени и, внутри интервала, по размеру файла"""
+
+    def __init__(self, filename: str, max_bytes: int, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes <= 0 or not os.path.exists(self.baseFilename):
+            return False
+        return os.path.getsize(self.baseFilename) >= self.max_bytes
+
+    def rotation_filename(self, default_name: str) -> str:
+        # Несколько ротаций по размеру за один интервал: bot.log.2024-01-01.001, .002...
+        name = super().rotation_filename(default_name)
+        if not os.path.exists(name):
+            return name
+        index = 1
+        while os.path.exists(f"{name}.{index:03d}"):
+            index += 1
+        return f"{name}.{index:03d}"
+
+
+def shard_log_file(index: int, filename: str = LOG_FILE) -> str:
+    """Свой файл лога для воркера шарда: один файл не ротируют несколько процессов"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.shard-{index}{ext}"
+
+
+def _stop():
+    """Дописать очередь и закрыть обработчики"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+
+
+def setup_logging(filename: str = LOG_FILE):
+    """
+    Настроить логирование через очередь (в файл с ротацией и в консоль).
+    Повторный вызов переключает вывод, например на файл воркера шарда.
+    """
+    global _listener, _queue_handler
+    _stop()
+
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    file_handler = SizedTimedRotatingFileHandler(
+        filename,
+        max_bytes=int(LOG_MAX_MB * 1024 * 1024),
+        when=LOG_ROTATE_WHEN,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding='utf-8',
+        delay=True,
+    )
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(formatter)
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    _queue_handler = _QueueHandler(records)
+    _listener = logging.handlers.QueueListener(
+        records, file_handler, console_handler, respect_handler_level=True
+    )
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(_queue_handler)
+    _listener.start()
+
+
+# При выходе — дописать всё, что осталось в очереди
+atexit.register(_stop)
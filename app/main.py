@@ -8,25 +8,79 @@ import sys
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
-from app.config import BOT_TOKEN
-from app.db import init_db, load_messages_to_db
+from app.config import BOT_TOKEN, BOT_MODE, TELEGRAM_API_URL, SHARD_COUNT
+from app.db import init_db, load_messages_to_db, close_db, flush_writes
 from app.data.messages import get_all_messages
-from app.scheduler import set_bot, start_scheduler, stop_scheduler
+from app.data.scenario import build_scenario
+from app.scheduler import set_bot, start_scheduler, stop_scheduler, on_outbox_done
+from app.services.outbox import start_dispatcher, stop_dispatcher
+from app.services.jobs import stop_jobs
+from app.sharding import create_router_dispatcher
+from app.webhook import run_webhook
+from app.logs import setup_logging
 
 # Импорт роутеров
 from app.handlers import start, answers, admin
 
-# Настройка логирования — в файл и в консоль
-_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-_file_handler = logging.FileHandler('bot.log', encoding='utf-8')
-_file_handler.setFormatter(_log_formatter)
-_console_handler = logging.StreamHandler(sys.stdout)
-_console_handler.setFormatter(_log_formatter)
-logging.basicConfig(level=logging.INFO, handlers=[_file_handler, _console_handler])
+# Настройка логирования — в файл (с ротацией) и в консоль через фоновый поток
+setup_logging()
 logger = logging.getLogger(__name__)
 
 
+def create_bot() -> Bot:
+    """Создать бота (TELEGRAM_API_URL — свой или тестовый Bot API сервер)"""
+    session = None
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    return Bot(
+        token=BOT_TOKEN,
+        session=session,
+        default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)
+    )
+
+
+def create_dispatcher() -> Dispatcher:
+    """Создать диспетчер с обработчиками"""
+    dp = Dispatcher()
+    
+    # Регистрация роутеров
+    # Важно: admin должен быть перед answers, чтобы команды обрабатывались первыми
+    dp.include_router(admin.router)
+    dp.include_router(start.router)
+    dp.include_router(answers.router)  # Должен быть последним (ловит все текстовые сообщения)
+    return dp
+
+
+async def start_services(bot: Bot):
+    """Запустить рассылку: диспетчер доставки и планировщик"""
+    # Установка бота для планировщика
+    set_bot(bot)
+    
+    # Запуск диспетчера доставки (outbox)
+    await start_dispatcher(bot, on_done=on_outbox_done)
+    
+    # Запуск планировщика (расписание строится из БД)
+    await start_scheduler()
+
+
+async def stop_services():
+    """Остановить рассылку и зафиксировать отложенные записи"""
+    # Остановка ручной рассылки, если она идёт
+    await stop_jobs()
+    
+    # Остановка планировщика
+    await stop_scheduler()
+    
+    # Остановка диспетчера доставки
+    await stop_dispatcher()
+    
+    # Фиксация отложенных записей логов
+    await flush_writes()
+
+
 async def on_startup(bot: Bot):
     """Действия при запуске бота"""
     logger.info("🚀 Бот запускается...")
@@ -37,12 +91,9 @@ async def on_startup(bot: Bot):
     # Загрузка сценария сообщений
     messages = get_all_messages()
     await load_messages_to_db(messages)
+    build_scenario(messages)
     
-    # Установка бота для планировщика
-    set_bot(bot)
-    
-    # Запуск планировщика
-    start_scheduler()
+    await start_services(bot)
     
     logger.info("✅ Бот успешно запущен!")
 
@@ -51,8 +102,10 @@ async def on_shutdown(bot: Bot):
     """Действия при остановке бота"""
     logger.info("⏹️ Бот останавливается...")
     
-    # Остановка планировщика
-    stop_scheduler()
+    await stop_services()
+    
+    # Закрытие пула соединений с БД
+    await close_db()
     
     logger.info("👋 Бот остановлен")
 
@@ -65,29 +118,29 @@ async def main():
         logger.error("❌ Укажите BOT_TOKEN в config.py или переменных окружения!")
         sys.exit(1)
     
-    # Создание бота
-    bot = Bot(
-        token=BOT_TOKEN,
-        default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)
-    )
-    
-    # Создание диспетчера
-    dp = Dispatcher()
-    
-    # Регистрация роутеров
-    # Важно: admin должен быть перед answers, чтобы команды обрабатывались первыми
-    dp.include_router(admin.router)
-    dp.include_router(start.router)
-    dp.include_router(answers.router)  # Должен быть последним (ловит все текстовые сообщения)
+    bot = create_bot()
     
-    # Регистрация обработчиков жизненного цикла
-    dp.startup.register(on_startup)
-    dp.shutdown.register(on_shutdown)
+    if SHARD_COUNT > 1:
+        # Этот процесс только принимает обновления и раздаёт их воркерам шардов
+        allowed_updates = create_dispatcher().resolve_used_update_types()
+        dp = create_router_dispatcher(SHARD_COUNT)
+    else:
+        dp = create_dispatcher()
+        allowed_updates = dp.resolve_used_update_types()
+        
+        # Регистрация обработчиков жизненного цикла
+        dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
     
-    # Запуск поллинга
+    # Запуск в выбранном режиме
     try:
-        logger.info("🤖 Запуск polling...")
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot, allowed_updates)
+        else:
+            logger.info("🤖 Запуск polling...")
+            # Webhook, оставшийся от режима webhook, мешает getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=allowed_updates)
     finally:
         await bot.session.close()
 
@@ -1,32 +1,49 @@
 """
-Планировщик для автоматической рассылки сообщений
+Планировщик для автоматической рассылки сообщений.
+
+Вместо ежеминутного опроса держит в памяти min-heap со временем следующей
+отправки для каждого пользователя и спит ровно до ближайшего дедлайна.
 """
+import asyncio
+import heapq
 import logging
-from datetime import datetime
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.interval import IntervalTrigger
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
 import pytz
 
 logger = logging.getLogger(__name__)
 
 from app.config import (
-    MESSAGE_INTERVAL_MINUTES, 
-    WORK_HOURS_START, 
+    MESSAGE_INTERVAL_MINUTES,
+    WORK_HOURS_START,
     WORK_HOURS_END,
     TIMEZONE
 )
 from app.db import (
-    get_active_users,
-    get_message_by_index,
-    log_sent_message,
-    get_total_messages,
-    get_user_last_message_time,
-    get_user_next_message_index,
+    get_due_users,
+    get_schedule,
+    enqueue_messages,
 )
+from app.data.scenario import get_scenario
+from app.services.outbox import kick_dispatcher
+
+# Через сколько секунд перепроверить пользователя, если рассылка его не обработала
+SEND_RETRY_SECONDS = 60
 
 # Глобальная переменная для бота (будет установлена из main.py)
 bot = None
-scheduler = None
+
+# Расписание: куча (время, user_id) и актуальное время для каждого пользователя.
+# Устаревшие записи в куче не удаляются сразу, а пропускаются при извлечении.
+_heap: List[Tuple[datetime, int]] = []
+_deadlines: Dict[int, datetime] = {}
+_wakeup: Optional[asyncio.Event] = None
+_timer_task: Optional[asyncio.Task] = None
+
+# Блокировки пользователей: рассылка и старт/стоп тренировки не меняют
+# состояние одного пользователя одновременно. Блокировка создаётся на
+# пользователя один раз — их не больше, чем пользователей.
+_user_locks: Dict[int, asyncio.Lock] = {}
 
 
 def set_bot(bot_instance):
@@ -35,14 +52,6 @@ def set_bot(bot_instance):
     bot = bot_instance
 
 
-def get_scheduler():
-    """Получить экземпляр планировщика"""
-    global scheduler
-    if scheduler is None:
-        scheduler = AsyncIOScheduler(timezone=TIMEZONE)
-    return scheduler
-
-
 def is_work_time() -> bool:
     """Проверить, находимся ли мы в рабочем окне"""
     tz = pytz.timezone(TIMEZONE)
@@ -51,96 +60,281 @@ def is_work_time() -> bool:
     return WORK_HOURS_START <= current_hour < WORK_HOURS_END
 
 
-async def send_training_messages():
+def seconds_until_work_time() -> float:
+    """Сколько секунд осталось до начала ближайшего рабочего окна"""
+    tz = pytz.timezone(TIMEZONE)
+    now = datetime.now(tz)
+    start = now.replace(hour=WORK_HOURS_START, minute=0, second=0, microsecond=0)
+    if now >= start:
+        start += timedelta(days=1)
+    return max(1.0, (start - now).total_seconds())
+
+
+def user_lock(user_id: int) -> asyncio.Lock:
+    """Блокировка состояния пользователя внутри процесса"""
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+# ===== Расписание пользователей =====
+
+def _wake():
+    """Разбудить цикл таймеров, чтобы он пересчитал ближайший дедлайн"""
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+def schedule_user(user_id: int, due_at: Optional[datetime] = None):
+    """Запланировать следующую отправку пользователю (по умолчанию — сейчас)"""
+    if due_at is None:
+        due_at = datetime.now()
+    _deadlines[user_id] = due_at
+    heapq.heappush(_heap, (due_at, user_id))
+    _wake()
+
+
+def unschedule_user(user_id: int):
+    """Убрать пользователя из расписания (тренировка остановлена)"""
+    _deadlines.pop(user_id, None)
+
+
+def clear_schedule():
+    """Очистить расписание всех пользователей"""
+    _deadlines.clear()
+    _heap.clear()
+    _wake()
+
+
+def _next_deadline() -> Optional[datetime]:
+    """Ближайший актуальный дедлайн (устаревшие записи выбрасываются)"""
+    while _heap:
+        due_at, user_id = _heap[0]
+        if _deadlines.get(user_id) == due_at:
+            return due_at
+        heapq.heappop(_heap)
+    return None
+
+
+def _pop_due(now: datetime) -> List[int]:
+    """Извлечь всех пользователей, чей дедлайн наступил"""
+    due = []
+    while True:
+        due_at = _next_deadline()
+        if due_at is None or due_at > now:
+            return due
+        _, user_id = heapq.heappop(_heap)
+        del _deadlines[user_id]
+        due.append(user_id)
+
+
+async def _load_schedule(user_ids: Optional[List[int]] = None):
+    """Построить расписание из БД (для всех или для указанных пользователей)"""
+    rows = await get_schedule(get_scenario().total, user_ids)
+    now = datetime.now()
+    interval = timedelta(minutes=MESSAGE_INTERVAL_MINUTES)
+
+    for row in rows:
+        if row['last_sent_at']:
+            due_at = datetime.fromisoformat(row['last_sent_at']) + interval
+        else:
+            due_at = now
+        if user_ids is not None and due_at <= now:
+            # Пользователь уже был в рассылке, но не обработан — не крутимся вхолостую
+            due_at = now + timedelta(seconds=SEND_RETRY_SECONDS)
+        schedule_user(row['user_id'], due_at)
+
+    return len(rows)
+
+
+async def rebuild_schedule():
+    """Полностью перестроить расписание из БД"""
+    clear_schedule()
+    count = await _load_schedule()
+    logger.info(f"Расписание построено: {count} активных пользователей")
+
+
+async def _queue_batch(users: List[Dict], now: datetime, result: Dict[str, int]) -> List[int]:
+    """Поставить в outbox сообщения для части due-пользователей; вернуть id строк outbox"""
+    scenario = get_scenario()
+    items = []
+    held = []
+    try:
+        for user in users:
+            lock = user_lock(user['user_id'])
+            if lock.locked():
+                # Пользователя сейчас обрабатывает другой запуск или старт/стоп
+                result["skipped"] += 1
+                continue
+            message = scenario.get(user['next_index'])
+            if message is None:
+                logger.warning(f"Сообщение {user['next_index']} не найдено")
+                result["skipped"] += 1
+                continue
+            # Свободная блокировка захватывается сразу, без ожидания
+            await lock.acquire()
+            held.append(lock)
+            items.append({
+                "user_id": user['user_id'],
+                "message_index": message.index,
+                "message_text": message.text,
+                "rendered_text": message.rendered,
+            })
+
+        # Ставим в outbox вместе с продвижением прогресса, доставит диспетчер
+        outbox_ids = await enqueue_messages(items, now.isoformat()) if items else []
+    finally:
+        for lock in held:
+            lock.release()
+
+    queued = []
+    for item, outbox_id in zip(items, outbox_ids):
+        if outbox_id is None:
+            result["skipped"] += 1
+            continue
+        result["queued"] += 1
+        queued.append(outbox_id)
+        # Предварительный дедлайн; после доставки пересчитается от времени отправки
+        schedule_user(item['user_id'], now + timedelta(minutes=MESSAGE_INTERVAL_MINUTES))
+    if queued:
+        kick_dispatcher()
+    return queued
+
+
+async def send_training_messages(
+    batch_size: Optional[int] = None,
+    on_batch: Optional[Callable[[List[int], Dict[str, int]], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None
+) -> Dict[str, int]:
     """
     Основная функция рассылки сообщений.
-    Вызывается каждую минуту, отправляет каждому пользователю
-    следующее сообщение если прошло >= MESSAGE_INTERVAL_MINUTES с последнего.
+    Отправляет каждому пользователю следующее сообщение, если прошло
+    >= MESSAGE_INTERVAL_MINUTES с последнего, и планирует следующую отправку.
+
+    Безопасна при одновременных запусках (таймер, /send_now): пользователь,
+    которого уже обрабатывает другой запуск, пропускается, а прогресс
+    продвигается compare-and-set — одно сообщение не уйдёт дважды.
+
+    batch_size — ставить в outbox порциями; после каждой вызывается
+    on_batch(id строк outbox, итоги на текущий момент), а should_stop()
+    может прервать рассылку между порциями.
+    Возвращает {"queued": поставлено в outbox, "skipped": пропущено}.
     """
     global bot
+    result = {"queued": 0, "skipped": 0}
 
     if bot is None:
         logger.warning("Бот не инициализирован")
-        return
+        return result
 
     # Проверка рабочего времени
     if not is_work_time():
         logger.info(f"Вне рабочего времени ({WORK_HOURS_START}:00 - {WORK_HOURS_END}:00)")
-        return
+        return result
 
-    active_users = await get_active_users()
-    if not active_users:
-        return
-
-    total_messages = await get_total_messages()
     now = datetime.now()
+    due_users = await get_due_users(now, MESSAGE_INTERVAL_MINUTES, get_scenario().total)
+    if not due_users:
+        return result
 
-    for user in active_users:
-        user_id = user['user_id']
+    size = batch_size or len(due_users)
+    for start in range(0, len(due_users), size):
+        if should_stop is not None and should_stop():
+            break
+        queued = await _queue_batch(due_users[start:start + size], now, result)
+        if on_batch is not None:
+            on_batch(queued, result)
 
-        # Проверяем, прошло ли достаточно времени с последнего сообщения
-        last_time = await get_user_last_message_time(user_id)
-        if last_time is not None:
-            elapsed_minutes = (now - last_time).total_seconds() / 60
-            if elapsed_minutes < MESSAGE_INTERVAL_MINUTES:
-                continue
+    logger.info(
+        f"В очередь на отправку поставлено сообщений: {result['queued']}, "
+        f"пропущено: {result['skipped']}"
+    )
+    return result
 
-        # Определяем следующий индекс для этого пользователя
-        next_index = await get_user_next_message_index(user_id)
-        if next_index > total_messages:
-            logger.info(f"Все сообщения отправлены пользователю {user_id}")
-            continue
 
-        message_data = await get_message_by_index(next_index)
-        if not message_data:
-            logger.warning(f"Сообщение {next_index} не найдено")
-            continue
+async def on_outbox_done(message: Dict, sent_at: Optional[datetime]):
+    """Планирование после доставки (или dead-letter) сообщения из outbox"""
+    user_id = message['user_id']
+    if message['message_index'] >= get_scenario().total:
+        unschedule_user(user_id)
+        logger.info(
+            f"Все сообщения отправлены пользователю {user_id}",
+            extra={"user_id": user_id, "message_index": message['message_index']}
+        )
+        return
+    anchor = sent_at or datetime.now()
+    schedule_user(user_id, anchor + timedelta(minutes=MESSAGE_INTERVAL_MINUTES))
 
-        message_text = f"📨 *Сообщение #{next_index}*\n\n"
-        message_text += f"_{message_data.get('category', 'Общее')}_\n\n"
-        message_text += message_data['text']
 
-        sent_at = now.isoformat()
+async def _run_due(user_ids: List[int]):
+    """Разослать сообщения пользователям, чей дедлайн наступил"""
+    try:
+        await send_training_messages()
+    except Exception as e:
+        logger.error(f"Ошибка рассылки: {e}")
+
+    # Кого рассылка не перепланировала — сверяем с БД
+    # (остановлен, закончил сценарий или отправка была позже)
+    missed = [user_id for user_id in user_ids if user_id not in _deadlines]
+    if missed:
         try:
-            await bot.send_message(
-                chat_id=user_id,
-                text=message_text,
-                parse_mode="Markdown"
-            )
-            await log_sent_message(
-                user_id=user_id,
-                message_index=next_index,
-                message_text=message_data['text'],
-                sent_at=sent_at
-            )
-            logger.info(f"Сообщение #{next_index} отправлено пользователю {user_id}")
+            await _load_schedule(missed)
         except Exception as e:
-            logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
+            # Не теряем пользователей: перепроверим их позже
+            logger.error(f"Ошибка загрузки расписания: {e}")
+            retry_at = datetime.now() + timedelta(seconds=SEND_RETRY_SECONDS)
+            for user_id in missed:
+                if user_id not in _deadlines:
+                    schedule_user(user_id, retry_at)
 
 
-def start_scheduler():
-    """Запустить планировщик"""
-    global scheduler
-    scheduler = get_scheduler()
-    
-    # Добавляем задачу рассылки
-    scheduler.add_job(
-        send_training_messages,
-        trigger=IntervalTrigger(minutes=1),
-        id='training_messages',
-        name='Рассылка тренировочных сообщений',
-        replace_existing=True
-    )
+async def _timer_loop():
+    """Цикл таймеров: спит до ближайшего дедлайна или до начала рабочего окна"""
+    while True:
+        _wakeup.clear()
 
-    scheduler.start()
-    logger.info(f"Планировщик запущен (проверка каждую минуту, интервал между сообщениями: {MESSAGE_INTERVAL_MINUTES} мин)")
+        try:
+            if not is_work_time():
+                delay = seconds_until_work_time()
+            else:
+                due_at = _next_deadline()
+                delay = None if due_at is None else (due_at - datetime.now()).total_seconds()
+                if delay is not None and delay <= 0:
+                    await _run_due(_pop_due(datetime.now()))
+                    continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Ошибка не должна останавливать таймер — повторим позже
+            logger.error(f"Ошибка цикла планировщика: {e}")
+            delay = SEND_RETRY_SECONDS
+
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
 
 
-def stop_scheduler():
+async def start_scheduler():
+    """Запустить планировщик"""
+    global _wakeup, _timer_task
+    _wakeup = asyncio.Event()
+    await rebuild_schedule()
+    _timer_task = asyncio.create_task(_timer_loop())
+    logger.info(f"Планировщик запущен (интервал между сообщениями: {MESSAGE_INTERVAL_MINUTES} мин)")
+
+
+async def stop_scheduler():
     """Остановить планировщик"""
-    global scheduler
-    if scheduler and scheduler.running:
-        scheduler.shutdown()
+    global _timer_task
+    if _timer_task is not None:
+        _timer_task.cancel()
+        try:
+            await _timer_task
+        except asyncio.CancelledError:
+            pass
+        _timer_task = None
         print("⏹️ Планировщик остановлен")
 
 
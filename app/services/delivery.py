@@ -0,0 +1,93 @@
+"""
+Сервис доставки сообщений в Telegram с ограничением скорости.
+
+Общий token bucket держит суммарную скорость в пределах лимита Bot API,
+а отдельный лимитер разносит сообщения в один чат по времени. Число
+одновременных запросов задаёт число воркеров outbox (OUTBOX_WORKERS).
+Повторы при ошибках здесь не делаются — их планирует outbox, единая
+политика повторов.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from app.config import TELEGRAM_RATE_LIMIT_PER_SEC, TELEGRAM_CHAT_INTERVAL_SEC
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket: не больше rate запросов в секунду, всплеск до capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Приостановить выдачу токенов (после flood control от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        """Дождаться и забрать один токен"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+_bucket = TokenBucket(TELEGRAM_RATE_LIMIT_PER_SEC, TELEGRAM_RATE_LIMIT_PER_SEC)
+
+
+def set_rate_limit(rate: float):
+    """Задать общий лимит процесса (воркер шарда получает свою долю)"""
+    global _bucket
+    _bucket = TokenBucket(rate, max(1.0, rate))
+
+
+# Ближайшее время, когда в чат можно отправить следующее сообщение
+_chat_next_slot: Dict[int, float] = {}
+
+
+async def _wait_chat_slot(chat_id: int):
+    """Занять слот для отправки в чат и дождаться его"""
+    now = time.monotonic()
+    if len(_chat_next_slot) > 10000:
+        for stale in [cid for cid, slot in _chat_next_slot.items() if slot < now]:
+            del _chat_next_slot[stale]
+
+    slot = max(now, _chat_next_slot.get(chat_id, 0.0))
+    _chat_next_slot[chat_id] = slot + TELEGRAM_CHAT_INTERVAL_SEC
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+
+async def deliver(bot, chat_id: int, text: str, **kwargs):
+    """
+    Отправить сообщение с учётом лимитов Telegram — одна попытка.
+    При flood control приостанавливает общий bucket на retry_after;
+    все ошибки пробрасываются вызывающему (outbox решает о повторе).
+    """
+    await _wait_chat_slot(chat_id)
+    await _bucket.acquire()
+    try:
+        return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    except TelegramRetryAfter as e:
+        logger.warning(f"Flood control, пауза {e.retry_after} сек (чат {chat_id})")
+        _bucket.pause(e.retry_after)
+        raise
@@ -1,12 +1,85 @@
 """
 Сервис экспорта данных в CSV
 """
+import asyncio
 import csv
+import gzip
+import io
 import os
+import tempfile
+import time
+import zipfile
 from datetime import datetime
-from typing import Optional
+from typing import (
+    IO, AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, Iterable, List,
+    NamedTuple, Optional, Tuple, Union,
+)
 
-from app.db import get_all_logs
+from aiogram.types import BufferedInputFile, FSInputFile, InputFile
+
+from app.config import (
+    EXPORT_CHUNK_SIZE,
+    EXPORT_COMPRESS,
+    EXPORT_RETENTION_DAYS,
+    EXPORT_MAX_TOTAL_MB,
+    EXPORT_IN_MEMORY,
+    EXPORT_MEMORY_MAX_MB,
+)
+from app.db import (
+    flush_writes,
+    iter_all_logs,
+    iter_user_logs,
+    iter_logs_by_user,
+    iter_logs_since,
+    get_export_watermark,
+    set_export_watermark,
+    get_logs_version,
+    get_export_artifact,
+    save_export_artifact,
+    set_export_file_id,
+    delete_export_artifacts,
+)
+
+EXPORT_DIR = "exports"
+
+# Экспорт в памяти: сколько держать в буфере, прежде чем вытеснить во временный файл
+EXPORT_MEMORY_MAX_BYTES = int(EXPORT_MEMORY_MAX_MB * 1024 * 1024)
+
+# Куда пишется экспорт: путь к файлу или бинарный буфер
+ExportTarget = Union[str, IO[bytes]]
+
+# Имя водяного знака общего отчёта
+ALL_LOGS_WATERMARK = "all_logs"
+
+# Столбцы общего отчёта (на русском)
+ALL_LOGS_FIELDNAMES = [
+    '№',
+    'ID пользователя',
+    'Ник Telegram',
+    'Имя',
+    '№ сообщения',
+    'Текст сообщения',
+    'Дата отправки',
+    'Время отправки',
+    'Ответ пользователя',
+    'Дата ответа',
+    'Время ответа',
+    'Время реакции (сек)',
+    'Время реакции'
+]
+
+# Столбцы отчёта по пользователю
+USER_REPORT_FIELDNAMES = [
+    '№ сообщения',
+    'Текст сообщения',
+    'Дата отправки',
+    'Время отправки',
+    'Ответ пользователя',
+    'Дата ответа',
+    'Время ответа',
+    'Время реакции (сек)',
+    'Время реакции'
+]
 
 
 def format_datetime(iso_string: str) -> tuple:
@@ -22,159 +95,489 @@ def format_datetime(iso_string: str) -> tuple:
         return "", ""
 
 
-async def export_logs_to_csv() -> Optional[str]:
+def format_response_time(response_time: Optional[int]) -> str:
+    """Форматировать время ответа для отчёта"""
+    if not response_time:
+        return ""
+    if response_time < 60:
+        return f"{response_time} сек"
+    elif response_time < 3600:
+        return f"{response_time // 60} мин {response_time % 60} сек"
+    else:
+        hours = response_time // 3600
+        minutes = (response_time % 3600) // 60
+        return f"{hours} ч {minutes} мин"
+
+
+def build_all_logs_row(log: Dict) -> List:
+    """Строка общего отчёта"""
+    response_time = log.get('response_time_sec')
+    sent_date, sent_time = format_datetime(log.get('sent_at', ''))
+    answered_date, answered_time = format_datetime(log.get('answered_at', ''))
+
+    # Добавляем @ к нику если его нет
+    username = log.get('username', '')
+    if username and not username.startswith('@'):
+        username = f"@{username}"
+
+    return [
+        log['id'],
+        log['user_id'],
+        username,
+        log.get('full_name', ''),
+        log['message_index'],
+        log.get('message_text', ''),
+        sent_date,
+        sent_time,
+        log.get('answer_text', ''),
+        answered_date,
+        answered_time,
+        response_time or '',
+        format_response_time(response_time)
+    ]
+
+
+def build_user_report_row(log: Dict) -> List:
+    """Строка отчёта по пользователю"""
+    response_time = log.get('response_time_sec')
+    sent_date, sent_time = format_datetime(log.get('sent_at', ''))
+    answered_date, answered_time = format_datetime(log.get('answered_at', ''))
+
+    return [
+        log['message_index'],
+        log.get('message_text', ''),
+        sent_date,
+        sent_time,
+        log.get('answer_text', ''),
+        answered_date,
+        answered_time,
+        response_time or '',
+        format_response_time(response_time)
+    ]
+
+
+def _open_export_file(target: ExportTarget, compress: bool):
+    """Открыть файл экспорта (CSV в UTF-8 с BOM, опционально gzip)"""
+    if compress:
+        # Для буфера GzipFile при закрытии допишет архив, но сам буфер не закроет
+        return gzip.open(target, 'wt', newline='', encoding='utf-8-sig')
+    if isinstance(target, str):
+        return open(target, 'w', newline='', encoding='utf-8-sig')
+    return io.TextIOWrapper(target, newline='', encoding='utf-8-sig')
+
+
+def _close_export_file(csvfile, target: ExportTarget, compress: bool):
+    """Закрыть файл экспорта; буфер в памяти остаётся открытым для отправки"""
+    if compress or isinstance(target, str):
+        csvfile.close()
+    else:
+        csvfile.flush()
+        csvfile.detach()
+
+
+def _write_rows(writer, logs: List[Dict], build_row: Callable[[Dict], List]):
+    """Отформатировать и записать порцию строк (выполняется в потоке)"""
+    writer.writerows(build_row(log) for log in logs)
+
+
+async def write_csv(
+    target: ExportTarget,
+    fieldnames: List[str],
+    chunks: AsyncIterator[List[Dict]],
+    build_row: Callable[[Dict], List],
+    compress: bool = False
+) -> int:
     """
-    Экспорт логов в CSV файл.
-    Возвращает путь к файлу или None, если нет данных.
+    Записать CSV из асинхронного потока порций логов в файл (путь) или
+    бинарный буфер. Ввод-вывод выполняется в потоке. Возвращает число строк.
     """
-    logs = await get_all_logs()
-    
-    if not logs:
-        return None
-    
-    # Создаём папку для экспорта, если её нет
-    export_dir = "exports"
-    if not os.path.exists(export_dir):
-        os.makedirs(export_dir)
-    
-    # Генерируем имя файла с датой
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"training_results_{timestamp}.csv"
-    filepath = os.path.join(export_dir, filename)
-    
-    # Определяем столбцы (на русском)
-    fieldnames = [
-        '№',
-        'ID пользователя',
-        'Ник Telegram',
-        'Имя',
-        '№ сообщения',
-        'Текст сообщения',
-        'Дата отправки',
-        'Время отправки',
-        'Ответ пользователя',
-        'Дата ответа',
-        'Время ответа',
-        'Время реакции (сек)',
-        'Время реакции'
-    ]
-    
-    # Записываем в CSV
-    with open(filepath, 'w', newline='', encoding='utf-8-sig') as csvfile:
+    csvfile = await asyncio.to_thread(_open_export_file, target, compress)
+    count = 0
+    try:
         writer = csv.writer(csvfile, delimiter=';')
-        writer.writerow(fieldnames)
-        
+        await asyncio.to_thread(writer.writerow, fieldnames)
+        async for logs in chunks:
+            await asyncio.to_thread(_write_rows, writer, logs, build_row)
+            count += len(logs)
+    finally:
+        await asyncio.to_thread(_close_export_file, csvfile, target, compress)
+    return count
+
+
+class ExportFile(NamedTuple):
+    """Готовый файл экспорта: на диске (path), в памяти (buffer) или уже в Telegram (file_id)"""
+    path: Optional[str]
+    count: int = 0
+    # Файл уже загружен в Telegram — можно отправить по file_id
+    file_id: Optional[str] = None
+    # Ключ и версия в кэше файлов (key None — файл не кэшируется)
+    key: Optional[str] = None
+    version: str = ""
+    # Водяной знак по выгруженным строкам (сохраняется commit_export_watermark)
+    watermark: Optional[Dict] = None
+    # Экспорт в памяти: буфер (при большом объёме — временный файл) и имя файла
+    buffer: Optional[IO[bytes]] = None
+    filename: str = ""
+
+    @property
+    def has_data(self) -> bool:
+        return bool(self.path or self.buffer is not None or self.file_id)
+
+
+async def _track_watermark(chunks: AsyncIterator[List[Dict]], watermark: Dict) -> AsyncIterator[List[Dict]]:
+    """Пропустить порции логов, сдвигая водяной знак до максимальных id и времени ответа"""
+    async for logs in chunks:
         for log in logs:
-            # Форматируем время ответа
-            response_time = log.get('response_time_sec')
-            if response_time:
-                if response_time < 60:
-                    formatted_time = f"{response_time} сек"
-                elif response_time < 3600:
-                    formatted_time = f"{response_time // 60} мин {response_time % 60} сек"
-                else:
-                    hours = response_time // 3600
-                    minutes = (response_time % 3600) // 60
-                    formatted_time = f"{hours} ч {minutes} мин"
-            else:
-                formatted_time = ""
-            
-            # Форматируем даты
-            sent_date, sent_time = format_datetime(log.get('sent_at', ''))
-            answered_date, answered_time = format_datetime(log.get('answered_at', ''))
-            
-            # Добавляем @ к нику если его нет
-            username = log.get('username', '')
-            if username and not username.startswith('@'):
-                username = f"@{username}"
-            
-            row = [
-                log['id'],
-                log['user_id'],
-                username,
-                log.get('full_name', ''),
-                log['message_index'],
-                log.get('message_text', ''),
-                sent_date,
-                sent_time,
-                log.get('answer_text', ''),
-                answered_date,
-                answered_time,
-                response_time or '',
-                formatted_time
-            ]
-            writer.writerow(row)
-    
-    print(f"✅ Экспортировано {len(logs)} записей в {filepath}")
-    return filepath
-
-
-async def export_user_report(user_id: int, username: str = "", full_name: str = "") -> Optional[str]:
-    """Экспорт отчёта по конкретному пользователю"""
-    logs = await get_all_logs()
-    user_logs = [log for log in logs if log['user_id'] == user_id]
-    
-    if not user_logs:
-        return None
-    
-    export_dir = "exports"
-    if not os.path.exists(export_dir):
-        os.makedirs(export_dir)
-    
+            if log['id'] > watermark['last_log_id']:
+                watermark['last_log_id'] = log['id']
+            if log.get('answered_at') and log['answered_at'] > watermark['last_answered_at']:
+                watermark['last_answered_at'] = log['answered_at']
+        yield logs
+
+
+def _new_target(name: str, compress: bool, in_memory: bool,
+                extension: Optional[str] = None) -> Tuple[ExportTarget, str]:
+    """
+    Куда писать новый экспорт: файл в папке экспорта (создаётся при
+    необходимости) или буфер в памяти, который вытесняется во временный
+    файл сверх EXPORT_MEMORY_MAX_BYTES. Возвращает (цель, имя файла).
+    """
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    # Используем username или ID для имени файла
+    if extension is None:
+        extension = "csv.gz" if compress else "csv"
+    filename = f"{name}_{timestamp}.{extension}"
+    if in_memory:
+        return tempfile.SpooledTemporaryFile(max_size=EXPORT_MEMORY_MAX_BYTES, mode='w+b'), filename
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    return os.path.join(EXPORT_DIR, filename), filename
+
+
+def user_report_name(user_id: int, username: str = "") -> str:
+    """Имя отчёта пользователя: ник или ID"""
     safe_name = username.replace('@', '') if username else str(user_id)
-    filename = f"user_{safe_name}_{timestamp}.csv"
-    filepath = os.path.join(export_dir, filename)
-    
-    # Заголовки на русском
-    fieldnames = [
-        '№ сообщения',
-        'Текст сообщения',
-        'Дата отправки',
-        'Время отправки',
-        'Ответ пользователя',
-        'Дата ответа',
-        'Время ответа',
-        'Время реакции (сек)',
-        'Время реакции'
-    ]
-    
-    with open(filepath, 'w', newline='', encoding='utf-8-sig') as csvfile:
-        writer = csv.writer(csvfile, delimiter=';')
-        writer.writerow(fieldnames)
-        
-        for log in user_logs:
-            # Форматируем время ответа
-            response_time = log.get('response_time_sec')
-            if response_time:
-                if response_time < 60:
-                    formatted_time = f"{response_time} сек"
-                elif response_time < 3600:
-                    formatted_time = f"{response_time // 60} мин {response_time % 60} сек"
-                else:
-                    hours = response_time // 3600
-                    minutes = (response_time % 3600) // 60
-                    formatted_time = f"{hours} ч {minutes} мин"
-            else:
-                formatted_time = ""
-            
-            # Форматируем даты
-            sent_date, sent_time = format_datetime(log.get('sent_at', ''))
-            answered_date, answered_time = format_datetime(log.get('answered_at', ''))
-            
-            row = [
-                log['message_index'],
-                log.get('message_text', ''),
-                sent_date,
-                sent_time,
-                log.get('answer_text', ''),
-                answered_date,
-                answered_time,
-                response_time or '',
-                formatted_time
-            ]
-            writer.writerow(row)
-    
-    print(f"✅ Экспортировано {len(user_logs)} записей пользователя {user_id} в {filepath}")
-    return filepath
+    return f"user_{safe_name}"
+
+
+class _BundleWriter:
+    """
+    ZIP-архив с отдельным CSV на каждого пользователя. Логи приходят
+    упорядоченными по user_id, поэтому в каждый момент открыт только
+    один элемент архива. Методы выполняются в потоке.
+    """
+
+    def __init__(self, target: ExportTarget):
+        self.archive = zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.user_id: Optional[int] = None
+        self.entry = None
+        self.writer = None
+        self.users = 0
+
+    def _open_entry(self, log: Dict):
+        self._close_entry()
+        self.user_id = log['user_id']
+        name = f"{user_report_name(log['user_id'], log.get('username') or '')}_{log['user_id']}.csv"
+        self.entry = io.TextIOWrapper(
+            self.archive.open(name, 'w'), encoding='utf-8-sig', newline=''
+        )
+        self.writer = csv.writer(self.entry, delimiter=';')
+        self.writer.writerow(USER_REPORT_FIELDNAMES)
+        self.users += 1
+
+    def _close_entry(self):
+        if self.entry is not None:
+            self.entry.close()
+            self.entry = None
+
+    def write(self, logs: List[Dict]):
+        for log in logs:
+            if log['user_id'] != self.user_id:
+                self._open_entry(log)
+            self.writer.writerow(build_user_report_row(log))
+
+    def close(self):
+        try:
+            self._close_entry()
+        finally:
+            self.archive.close()
+
+
+async def _finish_export(target: ExportTarget, filename: str, count: int) -> ExportFile:
+    """Удалить пустой экспорт; вернуть файл, если данные были"""
+    if isinstance(target, str):
+        if count == 0:
+            await asyncio.to_thread(os.remove, target)
+            return ExportFile(None)
+        return ExportFile(target, count, filename=filename)
+    if count == 0:
+        await asyncio.to_thread(target.close)
+        return ExportFile(None)
+    return ExportFile(None, count, buffer=target, filename=filename)
+
+
+def _location(export: ExportFile) -> str:
+    return export.path if export.path else f"{export.filename} (в памяти)"
+
+
+# ===== Кэш файлов и хранение =====
+
+def _version_string(version: Dict, *extra) -> str:
+    """Версия данных одной строкой (для сравнения с кэшем)"""
+    parts = [version['max_id'], version['sent'], version['answered'], version['max_answered_at'], *extra]
+    return ":".join(str(part) for part in parts)
+
+
+def _cache_key(name: str, compress: bool) -> str:
+    return f"{name}:{'gz' if compress else 'csv'}"
+
+
+async def _reusable(key: str, version: str) -> Optional[Dict]:
+    """Прошлый файл с той же версией данных, если его ещё можно отправить"""
+    artifact = await get_export_artifact(key)
+    if artifact is None or artifact['version'] != version:
+        return None
+    if artifact['file_id'] or await asyncio.to_thread(os.path.exists, artifact['path']):
+        return artifact
+    return None
+
+
+async def _remember(key: str, version: str, filepath: str):
+    """Запомнить новый файл вместо устаревшего и почистить папку экспорта"""
+    previous = await get_export_artifact(key)
+    await save_export_artifact(key, version, filepath)
+    if previous and previous['path'] and previous['path'] != filepath:
+        await asyncio.to_thread(_remove_quietly, previous['path'])
+    await prune_exports([filepath])
+
+
+def _remove_quietly(filepath: str):
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+
+
+def _prune(directory: str, max_age_sec: float, max_bytes: float, keep: Iterable[str]) -> List[str]:
+    """Удалить файлы старше max_age_sec, затем самые старые сверх max_bytes (в потоке)"""
+    keep = {os.path.abspath(path) for path in keep}
+    files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return []
+
+    removed = []
+    now = time.time()
+    total = sum(size for _, size, _ in files)
+    for mtime, size, path in sorted(files):
+        if os.path.abspath(path) in keep:
+            continue
+        if now - mtime > max_age_sec or total > max_bytes:
+            _remove_quietly(path)
+            removed.append(path)
+            total -= size
+    return removed
+
+
+async def prune_exports(keep: Iterable[str] = ()) -> int:
+    """
+    Удалить старые файлы экспорта (по EXPORT_RETENTION_DAYS и
+    EXPORT_MAX_TOTAL_MB), не трогая keep. Возвращает число удалённых.
+    """
+    removed = await asyncio.to_thread(
+        _prune, EXPORT_DIR, EXPORT_RETENTION_DAYS * 86400, EXPORT_MAX_TOTAL_MB * 1024 * 1024, list(keep)
+    )
+    await delete_export_artifacts(removed)
+    return len(removed)
+
+
+async def remember_file_id(export: ExportFile, file_id: str):
+    """Запомнить file_id отправленного файла, чтобы не загружать его повторно"""
+    if export.key is None:
+        return
+    if export.buffer is not None:
+        # Файл из памяти на диске не хранится — переиспользуется только file_id
+        await save_export_artifact(export.key, export.version, "")
+    await set_export_file_id(export.key, export.version, file_id)
+
+
+# ===== Отправка =====
+
+class SpooledInputFile(InputFile):
+    """Файл экспорта, вытесненный из памяти во временный файл: читается порциями"""
+
+    def __init__(self, file: IO[bytes], filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        await asyncio.to_thread(self.file.seek, 0)
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
+
+
+def export_input_file(export: ExportFile) -> Union[str, InputFile]:
+    """
+    Документ для отправки: file_id прошлой загрузки, буфер из памяти
+    (BufferedInputFile) или файл на диске.
+    """
+    if export.file_id:
+        return export.file_id
+    if export.buffer is None:
+        return FSInputFile(export.path)
+    export.buffer.seek(0, os.SEEK_END)
+    size = export.buffer.tell()
+    export.buffer.seek(0)
+    if size <= EXPORT_MEMORY_MAX_BYTES:
+        return BufferedInputFile(export.buffer.read(), export.filename)
+    return SpooledInputFile(export.buffer, export.filename)
+
+
+async def close_export(export: ExportFile):
+    """Освободить буфер экспорта в памяти (временный файл удаляется)"""
+    if export.buffer is not None:
+        await asyncio.to_thread(export.buffer.close)
+
+
+# ===== Экспорт =====
+
+async def _write_all_logs(delta: bool, compress: bool, in_memory: bool) -> ExportFile:
+    """Записать общий отчёт (с водяным знаком по выгруженным строкам)"""
+    previous = await get_export_watermark(ALL_LOGS_WATERMARK)
+    watermark = {
+        "last_log_id": previous['last_log_id'],
+        "last_answered_at": previous['last_answered_at'],
+    }
+
+    if delta:
+        chunks = iter_logs_since(previous['last_log_id'], previous['last_answered_at'], EXPORT_CHUNK_SIZE)
+        target, filename = _new_target("training_results_delta", compress, in_memory)
+    else:
+        chunks = iter_all_logs(EXPORT_CHUNK_SIZE)
+        target, filename = _new_target("training_results", compress, in_memory)
+
+    count = await write_csv(
+        target, ALL_LOGS_FIELDNAMES, _track_watermark(chunks, watermark),
+        build_all_logs_row, compress
+    )
+
+    export = await _finish_export(target, filename, count)
+    if count:
+        print(f"✅ Экспортировано {count} записей в {_location(export)}")
+    return export._replace(watermark=watermark)
+
+
+async def export_logs(delta: bool = False, compress: bool = EXPORT_COMPRESS,
+                      in_memory: bool = EXPORT_IN_MEMORY) -> ExportFile:
+    """
+    Экспорт общего отчёта в CSV: полный или только новое с прошлого
+    экспорта (delta=True). Полный отчёт переиспользуется, пока данные
+    не менялись. in_memory=True — собрать в памяти, не записывая в exports/.
+    """
+    # Отложенные записи логов должны попасть в выгрузку до водяного знака
+    await flush_writes()
+
+    if delta:
+        export = await _write_all_logs(True, compress, in_memory)
+        if export.path:
+            await prune_exports([export.path])
+        return export
+
+    snapshot = await get_logs_version()
+    key, version = _cache_key("all_logs", compress), _version_string(snapshot)
+    artifact = await _reusable(key, version)
+    if artifact is not None:
+        watermark = {"last_log_id": snapshot['max_id'], "last_answered_at": snapshot['max_answered_at']}
+        return ExportFile(artifact['path'], snapshot['sent'], artifact['file_id'], key, version, watermark)
+
+    export = await _write_all_logs(False, compress, in_memory)
+    if export.path:
+        await _remember(key, version, export.path)
+    return export._replace(key=key, version=version)
+
+
+async def commit_export_watermark(export: ExportFile):
+    """
+    Сдвинуть водяной знак (последний id лога и время ответа) после того,
+    как отчёт доставлен: недоставленная выгрузка повторится в следующей.
+    """
+    if export.count and export.watermark:
+        await set_export_watermark(
+            ALL_LOGS_WATERMARK, export.watermark['last_log_id'], export.watermark['last_answered_at']
+        )
+
+
+async def _build_users_bundle(in_memory: bool) -> ExportFile:
+    """
+    Отчёты всех пользователей одним ZIP-архивом: один упорядоченный проход
+    по логам вместо отдельного экспорта на каждого пользователя.
+    """
+    target, filename = _new_target("users_dialogs", False, in_memory, extension="zip")
+    bundle = await asyncio.to_thread(_BundleWriter, target)
+    count = 0
+    try:
+        async for logs in iter_logs_by_user(EXPORT_CHUNK_SIZE):
+            await asyncio.to_thread(bundle.write, logs)
+            count += len(logs)
+    finally:
+        await asyncio.to_thread(bundle.close)
+
+    export = await _finish_export(target, filename, count)
+    if count:
+        print(f"✅ Экспортировано {count} записей {bundle.users} пользователей в {_location(export)}")
+    return export
+
+
+async def _build_user_report(user_id: int, username: str, compress: bool, in_memory: bool) -> ExportFile:
+    """Экспорт отчёта по конкретному пользователю"""
+    # Используем username или ID для имени файла
+    target, filename = _new_target(user_report_name(user_id, username), compress, in_memory)
+    count = await write_csv(
+        target, USER_REPORT_FIELDNAMES, iter_user_logs(user_id, EXPORT_CHUNK_SIZE),
+        build_user_report_row, compress
+    )
+
+    export = await _finish_export(target, filename, count)
+    if count:
+        print(f"✅ Экспортировано {count} записей пользователя {user_id} в {_location(export)}")
+    return export
+
+
+async def _cached(key: str, version: Dict, build: Callable[[], Awaitable[ExportFile]], *extra) -> ExportFile:
+    """
+    Вернуть файл из кэша по версии данных (максимальный id лога, число логов
+    и ответов, время последнего ответа) или собрать новый.
+    """
+    version_string = _version_string(version, *extra)
+    artifact = await _reusable(key, version_string)
+    if artifact is not None:
+        return ExportFile(artifact['path'], version['sent'], artifact['file_id'], key, version_string)
+    export = await build()
+    if export.path:
+        await _remember(key, version_string, export.path)
+    return export._replace(key=key, version=version_string)
+
+
+async def get_users_bundle(in_memory: bool = EXPORT_IN_MEMORY) -> ExportFile:
+    """Архив диалогов всех пользователей (из кэша, если данные не менялись)"""
+    await flush_writes()
+    return await _cached(
+        "users_bundle:zip", await get_logs_version(),
+        lambda: _build_users_bundle(in_memory),
+    )
+
+
+async def get_user_report(user_id: int, username: str = "",
+                          compress: bool = EXPORT_COMPRESS,
+                          in_memory: bool = EXPORT_IN_MEMORY) -> ExportFile:
+    """Отчёт по пользователю (из кэша, если его данные не менялись)"""
+    await flush_writes()
+    return await _cached(
+        _cache_key(f"user:{user_id}", compress),
+        await get_logs_version(user_id),
+        lambda: _build_user_report(user_id, username or "", compress, in_memory),
+        username or "",
+    )
@@ -0,0 +1,234 @@
+"""
+Фоновая ручная рассылка (/send_now, «Отправить сейчас»).
+
+Рассылка идёт задачей в фоне, а обработчик команды сразу возвращается.
+Прогресс (отправлено, пропущено, ошибок) показывается в сообщении со
+статусом, которое обновляется не чаще SEND_JOB_PROGRESS_SEC. Пока задача
+идёт, повторная команда не запускает новую, а подключается к текущей —
+её статус показывается и в новом сообщении.
+"""
+import asyncio
+import itertools
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from app.config import SEND_JOB_BATCH_SIZE, SEND_JOB_PROGRESS_SEC
+from app.db import get_outbox_statuses
+from app.services.outbox import add_outbox_listener, remove_outbox_listener
+
+logger = logging.getLogger(__name__)
+
+# Состояния задачи
+QUEUEING = "queueing"
+DELIVERING = "delivering"
+DONE = "done"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+STATE_TITLES = {
+    QUEUEING: "⏳ ставлю в очередь",
+    DELIVERING: "🚚 доставка",
+    DONE: "✅ завершена",
+    CANCELLED: "⏹ отменена",
+    FAILED: "⚠️ ошибка",
+}
+
+# Как часто сверять ожидаемые строки с outbox: строки удаляются при сбросе
+# тренировки, и итога доставки по ним уже не будет
+PENDING_CHECK_SEC = 30
+
+_ids = itertools.count(1)
+_current: Optional["SendJob"] = None
+
+
+class SendJob:
+    """Одна ручная рассылка и сообщения, в которых показывается её прогресс"""
+
+    def __init__(self, bot):
+        self.id = next(_ids)
+        self.bot = bot
+        self.state = QUEUEING
+        self.queued = 0
+        self.skipped = 0
+        self.sent = 0
+        self.failed = 0
+        self.task: Optional[asyncio.Task] = None
+        # Строки outbox этой рассылки, итог доставки которых ещё неизвестен
+        self._pending: Set[int] = set()
+        self._messages: List[Tuple[int, int]] = []
+        self._changed = asyncio.Event()
+        self._delivered = asyncio.Event()
+        self._edits: Set[asyncio.Task] = set()
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (DONE, CANCELLED, FAILED)
+
+    def text(self) -> str:
+        """Текст сообщения со статусом"""
+        text = (
+            f"📤 Рассылка #{self.id}: {STATE_TITLES[self.state]}\n\n"
+            f"📨 В очереди: {self.queued}\n"
+            f"✅ Отправлено: {self.sent}\n"
+            f"⏭ Пропущено: {self.skipped}\n"
+            f"❌ Ошибок: {self.failed}"
+        )
+        if self.state == CANCELLED and self._pending:
+            text += "\n\nУже поставленные в очередь сообщения будут доставлены."
+        return text
+
+    def keyboard(self) -> InlineKeyboardMarkup:
+        """Кнопка отмены, пока рассылка идёт, и «Назад» после"""
+        if self.finished:
+            button = InlineKeyboardButton(text="◀️ Назад", callback_data="admin_back")
+        else:
+            button = InlineKeyboardButton(text="⏹ Отменить", callback_data=f"job_cancel:{self.id}")
+        return InlineKeyboardMarkup(inline_keyboard=[[button]])
+
+    def attach(self, chat_id: int, message_id: int):
+        """Показывать прогресс ещё и в этом сообщении"""
+        self._messages.append((chat_id, message_id))
+        if self.finished:
+            # Обновление статуса уже завершилось — показать итог сразу
+            task = asyncio.create_task(self._edit(chat_id, message_id))
+            self._edits.add(task)
+            task.add_done_callback(self._edits.discard)
+        else:
+            self._changed.set()
+
+    def cancel(self):
+        """Не ставить в очередь оставшиеся порции (уже поставленные будут доставлены)"""
+        if not self.finished:
+            self.state = CANCELLED
+            self._delivered.set()
+            self._changed.set()
+
+    def _on_batch(self, outbox_ids: List[int], result: Dict[str, int]):
+        # Вызывается сразу после постановки порции, до первого переключения
+        # event loop, поэтому диспетчер ещё не успел доставить эти сообщения
+        self._pending.update(outbox_ids)
+        self.queued = result["queued"]
+        self.skipped = result["skipped"]
+        self._changed.set()
+
+    def _on_outbox(self, outbox_id: int, delivered: bool):
+        if outbox_id not in self._pending:
+            return
+        self._pending.discard(outbox_id)
+        if delivered:
+            self.sent += 1
+        else:
+            self.failed += 1
+        if not self._pending and self.state == DELIVERING:
+            self._delivered.set()
+        self._changed.set()
+
+    async def _reconcile(self):
+        """Учесть строки, итог которых прошёл мимо слушателя (или которые удалены)"""
+        statuses = await get_outbox_statuses(self._pending)
+        removed = 0
+        for outbox_id in list(self._pending):
+            status = statuses.get(outbox_id)
+            if status is None:
+                removed += 1
+                self._on_outbox(outbox_id, False)
+            elif status in ('delivered', 'dead'):
+                self._on_outbox(outbox_id, status == 'delivered')
+        if removed:
+            logger.warning(f"Рассылка #{self.id}: {removed} сообщений удалены из outbox до доставки")
+
+    async def _wait_delivered(self):
+        """Дождаться итога по всем строкам, раз в PENDING_CHECK_SEC сверяясь с outbox"""
+        while self._pending and not self._delivered.is_set():
+            try:
+                await asyncio.wait_for(self._delivered.wait(), timeout=PENDING_CHECK_SEC)
+            except asyncio.TimeoutError:
+                try:
+                    await self._reconcile()
+                except Exception as e:
+                    logger.error(f"Ошибка сверки рассылки #{self.id} с outbox: {e}")
+
+    async def _edit(self, chat_id: int, message_id: int):
+        try:
+            await self.bot.edit_message_text(
+                self.text(), chat_id=chat_id, message_id=message_id, reply_markup=self.keyboard()
+            )
+        except TelegramBadRequest as e:
+            # «message is not modified» и удалённые сообщения — не ошибка рассылки
+            logger.debug(f"Статус рассылки #{self.id} не обновлён: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка обновления статуса рассылки #{self.id}: {e}")
+
+    async def _refresh(self):
+        """Обновлять сообщения со статусом не чаще SEND_JOB_PROGRESS_SEC"""
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            await asyncio.gather(*(self._edit(*target) for target in self._messages))
+            if self.finished:
+                return
+            await asyncio.sleep(SEND_JOB_PROGRESS_SEC)
+
+    async def run(self):
+        """Поставить сообщения в очередь порциями и дождаться их доставки"""
+        from app.scheduler import send_training_messages
+
+        refresher = asyncio.create_task(self._refresh())
+        add_outbox_listener(self._on_outbox)
+        try:
+            await send_training_messages(
+                SEND_JOB_BATCH_SIZE,
+                on_batch=self._on_batch,
+                should_stop=lambda: self.state == CANCELLED,
+            )
+            if self.state != CANCELLED:
+                self.state = DELIVERING
+                self._changed.set()
+                await self._wait_delivered()
+                if self.state != CANCELLED:
+                    self.state = DONE
+        except Exception as e:
+            logger.error(f"Ошибка рассылки #{self.id}: {e}")
+            self.state = FAILED
+        finally:
+            remove_outbox_listener(self._on_outbox)
+            self._changed.set()
+            await refresher
+            logger.info(
+                f"Рассылка #{self.id}: {self.state}, в очереди {self.queued}, "
+                f"отправлено {self.sent}, пропущено {self.skipped}, ошибок {self.failed}"
+            )
+
+
+def start_send_job(bot) -> Tuple[SendJob, bool]:
+    """
+    Запустить ручную рассылку в фоне. Если рассылка уже идёт, вернуть её.
+    Возвращает (задача, создана ли новая).
+    """
+    global _current
+    if _current is not None and not _current.finished:
+        return _current, False
+    _current = SendJob(bot)
+    _current.task = asyncio.create_task(_current.run())
+    return _current, True
+
+
+def get_job(job_id: int) -> Optional[SendJob]:
+    """Текущая рассылка, если у неё такой id"""
+    if _current is not None and _current.id == job_id:
+        return _current
+    return None
+
+
+async def stop_jobs():
+    """Остановить идущую рассылку (при остановке бота)"""
+    if _current is None or _current.task is None or _current.task.done():
+        return
+    _current.cancel()
+    try:
+        await asyncio.wait_for(asyncio.shield(_current.task), timeout=SEND_JOB_PROGRESS_SEC + 5)
+    except asyncio.TimeoutError:
+        _current.task.cancel()
@@ -0,0 +1,208 @@
+"""
+Диспетчер outbox: пул воркеров, которые забирают сообщения из таблицы
+outbox, доставляют их в Telegram и фиксируют результат.
+
+Решение «что отправить» принимает планировщик (enqueue_messages),
+здесь — только ввод-вывод отправки, повторы и dead-letter.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
+
+from app.config import (
+    OUTBOX_WORKERS,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BACKOFF_BASE_SEC,
+    OUTBOX_BACKOFF_MAX_SEC,
+)
+from app.db import (
+    claim_outbox_message,
+    get_next_outbox_attempt,
+    mark_outbox_dead,
+    recover_outbox,
+    retry_outbox_message,
+    submit_outbox_delivered,
+)
+from app.services.delivery import deliver
+from app.services.sessions import on_delivered
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, которые не исправятся повтором (бот заблокирован, чат не найден, битый текст)
+PERMANENT_ERRORS = (TelegramForbiddenError, TelegramNotFound, TelegramBadRequest)
+
+# Колбэк: (outbox-сообщение, время отправки или None для dead-letter)
+OutboxCallback = Callable[[dict, Optional[datetime]], Awaitable[None]]
+
+# Слушатель итога доставки: (id строки outbox, доставлено ли)
+OutboxListener = Callable[[int, bool], None]
+
+_bot = None
+_on_done: Optional[OutboxCallback] = None
+_kick: Optional[asyncio.Event] = None
+_workers: List[asyncio.Task] = []
+_stopping = False
+_listeners: List[OutboxListener] = []
+
+# Сколько ждать завершения текущих отправок при остановке
+STOP_TIMEOUT_SEC = 10
+
+
+def kick_dispatcher():
+    """Сообщить воркерам, что в outbox появились новые сообщения"""
+    if _kick is not None:
+        _kick.set()
+
+
+def add_outbox_listener(listener: OutboxListener):
+    """Подписаться на итог доставки сообщений (доставлено или dead-letter)"""
+    _listeners.append(listener)
+
+
+def remove_outbox_listener(listener: OutboxListener):
+    """Отписаться от итогов доставки"""
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def _backoff(attempts: int) -> float:
+    """Задержка перед следующей попыткой (экспоненциальная, с потолком)"""
+    return min(OUTBOX_BACKOFF_MAX_SEC, OUTBOX_BACKOFF_BASE_SEC * 2 ** (attempts - 1))
+
+
+async def _notify(message: dict, sent_at: Optional[datetime]):
+    """Вызвать слушателей и колбэк планировщика, не роняя воркер"""
+    for listener in list(_listeners):
+        try:
+            listener(message['id'], sent_at is not None)
+        except Exception as e:
+            logger.error(f"Ошибка слушателя outbox: {e}")
+    if _on_done is None:
+        return
+    try:
+        await _on_done(message, sent_at)
+    except Exception as e:
+        logger.error(
+            f"Ошибка обработчика outbox для пользователя {message['user_id']}: {e}",
+            extra={"user_id": message['user_id'], "message_index": message['message_index']}
+        )
+
+
+async def _save_status(update: Callable[..., Awaitable[None]], outbox_id: int, *args):
+    """
+    Записать итог неудачной попытки (повтор или dead-letter), повторяя при
+    ошибке БД: строка, оставшаяся в sending, после перезапуска считалась бы доставленной.
+    """
+    while True:
+        try:
+            await update(outbox_id, *args)
+            return
+        except Exception as e:
+            logger.error(
+                f"Ошибка записи статуса outbox #{outbox_id}: {e}, "
+                f"повтор через {OUTBOX_BACKOFF_BASE_SEC:.0f} сек"
+            )
+            await asyncio.sleep(OUTBOX_BACKOFF_BASE_SEC)
+
+
+async def _process(message: dict):
+    """Доставить одно сообщение и записать результат"""
+    user_id = message['user_id']
+    # Поля для структурированного лога (LOG_FORMAT=json)
+    context = {"user_id": user_id, "message_index": message['message_index']}
+    try:
+        await deliver(_bot, user_id, message['rendered_text'], parse_mode="Markdown")
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        if isinstance(e, PERMANENT_ERRORS) or message['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            await _save_status(mark_outbox_dead, message['id'], error)
+            logger.error(
+                f"Сообщение #{message['message_index']} пользователю {user_id} "
+                f"не доставлено (попыток: {message['attempts']}): {error}",
+                extra=context
+            )
+            await _notify(message, None)
+        else:
+            delay = _backoff(message['attempts'])
+            if isinstance(e, TelegramRetryAfter):
+                # Раньше, чем разрешил Telegram, повторять бессмысленно
+                delay = max(delay, e.retry_after)
+            next_attempt_at = (datetime.now() + timedelta(seconds=delay)).isoformat()
+            await _save_status(retry_outbox_message, message['id'], next_attempt_at, error)
+            logger.warning(
+                f"Ошибка отправки пользователю {user_id}: {error}, повтор через {delay:.0f} сек",
+                extra=context
+            )
+        return
+
+    sent_at = datetime.now()
+    # Фиксация уходит в групповой коммит; если процесс упадёт до него,
+    # строка останется в sending и при запуске будет считаться доставленной
+    logged = submit_outbox_delivered(message['id'], sent_at.isoformat())
+    on_delivered(user_id, sent_at.isoformat(), logged)
+    logger.info(f"Сообщение #{message['message_index']} отправлено пользователю {user_id}", extra=context)
+    await _notify(message, sent_at)
+
+
+async def _worker():
+    """Воркер: забирает сообщения из outbox, пока они есть, потом ждёт сигнала"""
+    while not _stopping:
+        _kick.clear()
+        try:
+            message = await claim_outbox_message(datetime.now().isoformat())
+            if message is not None:
+                await _process(message)
+                continue
+            next_attempt = await get_next_outbox_attempt()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка диспетчера outbox: {e}")
+            next_attempt = datetime.now() + timedelta(seconds=OUTBOX_BACKOFF_BASE_SEC)
+
+        timeout = None
+        if next_attempt is not None:
+            timeout = max(0.0, (next_attempt - datetime.now()).total_seconds())
+        try:
+            await asyncio.wait_for(_kick.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def start_dispatcher(bot, on_done: Optional[OutboxCallback] = None):
+    """Запустить пул воркеров доставки (после восстановления outbox)"""
+    global _bot, _on_done, _kick, _stopping
+    _bot = bot
+    _stopping = False
+    _on_done = on_done
+    _kick = asyncio.Event()
+
+    recovered = await recover_outbox()
+    if recovered:
+        logger.warning(f"Outbox: {recovered} сообщений в статусе sending считаются доставленными")
+
+    for _ in range(OUTBOX_WORKERS):
+        _workers.append(asyncio.create_task(_worker()))
+    logger.info(f"Диспетчер outbox запущен ({OUTBOX_WORKERS} воркеров)")
+
+
+async def stop_dispatcher():
+    """Остановить воркеры доставки, дав им закончить текущие отправки"""
+    global _stopping
+    if not _workers:
+        return
+    _stopping = True
+    kick_dispatcher()
+    done, pending = await asyncio.wait(_workers, timeout=STOP_TIMEOUT_SEC)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
@@ -0,0 +1,128 @@
+"""
+Сессии пользователей для горячего пути ответов.
+
+В памяти держится флаг активности и текущий открытый (неотвеченный) лог
+каждого пользователя, поэтому запись ответа не требует чтений из БД —
+только одну запись save_answer. Сессия загружается из БД при первом
+обращении, дальше её обновляют диспетчер доставки, старт/стоп
+тренировки и сброс.
+"""
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+from app.db import flush_writes, get_last_unanswered_log, get_user
+
+logger = logging.getLogger(__name__)
+
+
+class UserSession:
+    """Состояние пользователя, нужное для приёма ответа"""
+
+    __slots__ = ("is_active", "log_id", "sent_at", "pending")
+
+    def __init__(self, is_active: bool, log_id: Optional[int] = None, sent_at: Optional[str] = None):
+        self.is_active = is_active
+        self.log_id = log_id
+        self.sent_at = sent_at
+        # Доставленное сообщение, запись о котором ещё в групповом коммите
+        self.pending: Optional[asyncio.Future] = None
+
+
+_sessions: Dict[int, UserSession] = {}
+
+# Счётчик доставок пользователям без сессии: если он изменился, пока сессия
+# читалась из БД, прочитанное могло устареть
+_untracked_deliveries = 0
+
+
+async def get_session(user_id: int) -> Optional[UserSession]:
+    """Сессия пользователя (при первом обращении — из БД); None, если пользователя нет"""
+    session = _sessions.get(user_id)
+    if session is not None:
+        return session
+
+    while True:
+        deliveries = _untracked_deliveries
+        # Отложенные записи о доставке должны попасть в БД до чтения
+        await flush_writes()
+        user = await get_user(user_id)
+        if user is None:
+            return None
+        log = await get_last_unanswered_log(user_id)
+        if deliveries == _untracked_deliveries:
+            break
+
+    loaded = UserSession(
+        bool(user.get('is_active')),
+        log['id'] if log else None,
+        log['sent_at'] if log else None,
+    )
+    # Пока читали, сессию могли создать старт/стоп или доставка
+    return _sessions.setdefault(user_id, loaded)
+
+
+async def get_open_log(session: UserSession) -> Optional[Tuple[int, str]]:
+    """Открытый лог сессии (id, sent_at); дожидается фиксации свежей доставки"""
+    if session.pending is not None:
+        try:
+            await asyncio.shield(session.pending)
+        except Exception:
+            pass
+    if session.log_id is None:
+        return None
+    return session.log_id, session.sent_at
+
+
+def start_session(user_id: int):
+    """Тренировка начата: логи пользователя очищены, открытого лога нет"""
+    _sessions[user_id] = UserSession(True)
+
+
+def stop_session(user_id: int):
+    """Тренировка остановлена"""
+    session = _sessions.get(user_id)
+    if session is not None:
+        session.is_active = False
+
+
+def on_delivered(user_id: int, sent_at: str, logged: asyncio.Future):
+    """
+    Сообщение доставлено; logged разрешится id записи лога после фиксации.
+    Если сессии ещё нет, она загрузится из БД при первом ответе.
+    """
+    global _untracked_deliveries
+    session = _sessions.get(user_id)
+    if session is None:
+        _untracked_deliveries += 1
+        return
+    session.pending = logged
+
+    def resolve(future: asyncio.Future):
+        if session.pending is not future:
+            return
+        session.pending = None
+        if future.cancelled() or future.exception() is not None or future.result() is None:
+            # Запись не состоялась — перечитаем состояние из БД при следующем ответе
+            if _sessions.get(user_id) is session:
+                del _sessions[user_id]
+            return
+        session.log_id = future.result()
+        session.sent_at = sent_at
+
+    logged.add_done_callback(resolve)
+
+
+def on_answered(user_id: int, log_id: int, next_log: Optional[Dict]):
+    """Ответ записан: открытым становится следующий неотвеченный лог"""
+    session = _sessions.get(user_id)
+    # Если за это время пришло новое сообщение, сессия уже указывает на него
+    if session is None or session.pending is not None or session.log_id != log_id:
+        return
+    session.log_id = next_log['id'] if next_log else None
+    session.sent_at = next_log['sent_at'] if next_log else None
+
+
+def clear_sessions():
+    """Сбросить все сессии (сброс тренировки)"""
+    _sessions.clear()
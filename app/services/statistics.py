@@ -0,0 +1,168 @@
+"""
+Сервис статистики тренировки.
+
+Данные берутся из материализованных счётчиков (stats_counters и
+stats_histogram), которые обновляются вместе с логами, — чтение не
+зависит от объёма истории. Перцентили приближённые: интерполяция
+внутри корзины гистограммы.
+"""
+from typing import Dict, List, Optional
+
+from app.cache import cached, STATS
+from app.db import (
+    RESPONSE_TIME_BUCKETS,
+    get_participants_count,
+    get_per_user_counters,
+    get_response_time_histogram,
+    get_stats_counter,
+    get_stats_counters,
+    get_user_counts,
+)
+
+# Перцентили времени ответа, которые показываем в статистике
+PERCENTILES = [50, 90, 99]
+
+
+def _average(total: int, count: int) -> int:
+    """Целое среднее (0, если данных нет)"""
+    return total // count if count else 0
+
+
+def _rate(part: int, total: int) -> int:
+    """Доля в процентах"""
+    return round(part / total * 100) if total > 0 else 0
+
+
+def histogram_percentiles(histogram: Dict[int, int], percents: List[int]) -> Dict[int, Optional[int]]:
+    """
+    Приближённые перцентили (nearest-rank) по гистограмме: внутри корзины,
+    в которую попал перцентиль, значение интерполируется линейно между её
+    границами. None — перцентиль в открытой последней корзине.
+    """
+    count = sum(histogram.values())
+    result = {}
+    for percent in percents:
+        if not count:
+            result[percent] = 0
+            continue
+        rank = max(1, -(-percent * count // 100))
+        cumulative = 0
+        for bucket in sorted(histogram):
+            if cumulative + histogram[bucket] >= rank:
+                break
+            cumulative += histogram[bucket]
+        if bucket >= len(RESPONSE_TIME_BUCKETS):
+            result[percent] = None
+            continue
+        lower = RESPONSE_TIME_BUCKETS[bucket - 1] if bucket > 0 else 0
+        upper = RESPONSE_TIME_BUCKETS[bucket]
+        result[percent] = round(lower + (upper - lower) * (rank - cumulative) / histogram[bucket])
+    return result
+
+
+@cached(STATS)
+async def get_training_statistics(per_user: bool = False, by_category: bool = False) -> Dict:
+    """
+    Сводная статистика: пользователи, отправлено/отвечено, доля ответов,
+    среднее время ответа и перцентили. per_user=True добавляет разбивку
+    по пользователям, by_category=True — по категориям сообщений.
+    """
+    users = await get_user_counts()
+    totals = await get_stats_counter('global')
+    percentiles = histogram_percentiles(await get_response_time_histogram('global'), PERCENTILES)
+
+    total_sent = totals['sent']
+    total_answered = totals['answered']
+
+    stats = {
+        "users_count": users['total_users'],
+        "active_users_count": users['active_users'],
+        "total_participants": await get_participants_count(),
+        "total_sent": total_sent,
+        "total_answered": total_answered,
+        "unanswered": total_sent - total_answered,
+        "answer_rate": _rate(total_answered, total_sent),
+        "avg_response_time_sec": _average(totals['response_time_sum'], totals['response_time_count']),
+        "percentiles": percentiles,
+    }
+
+    if per_user:
+        stats["users"] = await get_users_breakdown()
+    if by_category:
+        stats["categories"] = await get_categories_breakdown()
+
+    return stats
+
+
+async def get_users_breakdown() -> List[Dict]:
+    """Статистика по каждому пользователю, получавшему сообщения"""
+    rows = await get_per_user_counters()
+    return [
+        {
+            "user_id": row['user_id'],
+            "username": row['username'],
+            "full_name": row['full_name'],
+            "received": row['received'],
+            "answered": row['answered'],
+            "answer_rate": _rate(row['answered'], row['received']),
+            "avg_response_time_sec": _average(row['response_time_sum'], row['response_time_count']),
+        }
+        for row in rows
+    ]
+
+
+async def get_categories_breakdown() -> List[Dict]:
+    """Статистика по категориям сообщений"""
+    rows = await get_stats_counters('category')
+    return [
+        {
+            "category": row['key'] or "Без категории",
+            "sent": row['sent'],
+            "answered": row['answered'],
+            "answer_rate": _rate(row['answered'], row['sent']),
+            "avg_response_time_sec": _average(row['response_time_sum'], row['response_time_count']),
+        }
+        for row in rows
+    ]
+
+
+def format_duration(seconds: int) -> str:
+    """Время ответа для статистики: секунды или минуты с секундами"""
+    if seconds < 60:
+        return f"{seconds} сек"
+    return f"{seconds // 60} мин {seconds % 60} сек"
+
+
+def format_percentile(seconds: Optional[int]) -> str:
+    """Приближённый перцентиль (интерполяция внутри корзины гистограммы)"""
+    if seconds is None:
+        return f"> {format_duration(RESPONSE_TIME_BUCKETS[-1])}"
+    return format_duration(seconds)
+
+
+def format_statistics_text(stats: Dict, markdown: bool = False) -> str:
+    """Текст статистики для /stats и админ-панели"""
+    title = "📊 *Статистика тренировки:*" if markdown else "📊 Статистика тренировки:"
+    percentiles = stats['percentiles']
+
+    text = (
+        f"{title}\n\n"
+        f"👥 Пользователей: {stats['users_count']}\n"
+        f"🟢 Активных: {stats['active_users_count']}\n\n"
+        f"📨 Отправлено сообщений: {stats['total_sent']}\n"
+        f"✅ Получено ответов: {stats['total_answered']} ({stats['answer_rate']}%)\n"
+        f"📝 Без ответа: {stats['unanswered']}\n\n"
+        f"⏱ Среднее время ответа: {format_duration(stats['avg_response_time_sec'])}\n"
+        f"📶 Примерное время ответа — медиана: {format_percentile(percentiles[50])} | "
+        f"p90: {format_percentile(percentiles[90])} | "
+        f"p99: {format_percentile(percentiles[99])}"
+    )
+
+    if stats.get('categories'):
+        text += "\n\n🗂 По категориям:\n"
+        text += "\n".join(
+            f"• {item['category']}: {item['answered']}/{item['sent']} ({item['answer_rate']}%)"
+            for item in stats['categories']
+        )
+
+    return text
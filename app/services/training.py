@@ -4,19 +4,22 @@
 from typing import List, Dict, Optional
 from datetime import datetime
 
+from app.cache import cached, STATUS
 from app.db import (
     get_active_users,
     get_current_message_index,
-    get_total_messages,
-    get_all_logs
+    get_user_log_stats
 )
+from app.data.scenario import get_scenario
+from app.services.statistics import get_training_statistics
 
 
+@cached(STATUS)
 async def get_training_status() -> Dict:
     """Получить текущий статус тренировки"""
     active_users = await get_active_users()
     current_index = await get_current_message_index()
-    total_messages = await get_total_messages()
+    total_messages = get_scenario().total
     
     return {
         "active_users_count": len(active_users),
@@ -30,18 +33,16 @@ async def get_training_status() -> Dict:
 
 async def get_user_statistics(user_id: int) -> Dict:
     """Получить статистику конкретного пользователя"""
-    logs = await get_all_logs()
-    user_logs = [log for log in logs if log['user_id'] == user_id]
+    stats = await get_user_log_stats(user_id)
     
-    total_received = len(user_logs)
-    total_answered = sum(1 for log in user_logs if log.get('answer_text'))
+    total_received = stats['total_received']
+    total_answered = stats['total_answered']
     
     # Время ответов
-    response_times = [log['response_time_sec'] for log in user_logs if log.get('response_time_sec')]
-    
-    avg_response_time = sum(response_times) // len(response_times) if response_times else 0
-    min_response_time = min(response_times) if response_times else 0
-    max_response_time = max(response_times) if response_times else 0
+    response_count = stats['response_time_count']
+    avg_response_time = stats['response_time_sum'] // response_count if response_count else 0
+    min_response_time = stats['min_response_time_sec']
+    max_response_time = stats['max_response_time_sec']
     
     return {
         "user_id": user_id,
@@ -57,35 +58,17 @@ async def get_user_statistics(user_id: int) -> Dict:
 
 async def get_overall_statistics() -> Dict:
     """Получить общую статистику по всем пользователям"""
-    logs = await get_all_logs()
-    active_users = await get_active_users()
-    
-    total_sent = len(logs)
-    total_answered = sum(1 for log in logs if log.get('answer_text'))
-    
-    response_times = [log['response_time_sec'] for log in logs if log.get('response_time_sec')]
-    avg_time = sum(response_times) // len(response_times) if response_times else 0
-    
-    # Группировка по пользователям
-    users_stats = {}
-    for log in logs:
-        uid = log['user_id']
-        if uid not in users_stats:
-            users_stats[uid] = {"received": 0, "answered": 0, "times": []}
-        users_stats[uid]["received"] += 1
-        if log.get('answer_text'):
-            users_stats[uid]["answered"] += 1
-        if log.get('response_time_sec'):
-            users_stats[uid]["times"].append(log['response_time_sec'])
+    stats = await get_training_statistics()
     
     return {
-        "active_users_count": len(active_users),
-        "total_participants": len(users_stats),
-        "total_messages_sent": total_sent,
-        "total_answers": total_answered,
-        "unanswered": total_sent - total_answered,
-        "avg_response_time_sec": avg_time,
-        "answer_rate": round(total_answered / total_sent * 100) if total_sent > 0 else 0
+        "active_users_count": stats['active_users_count'],
+        "total_participants": stats['total_participants'],
+        "total_messages_sent": stats['total_sent'],
+        "total_answers": stats['total_answered'],
+        "unanswered": stats['unanswered'],
+        "avg_response_time_sec": stats['avg_response_time_sec'],
+        "answer_rate": stats['answer_rate'],
+        "response_time_percentiles": stats['percentiles']
     }
 
 
@@ -0,0 +1,299 @@
+"""
+Шардированный режим: пользователи распределены между процессами-воркерами.
+
+Главный процесс (роутер) только принимает обновления — polling или webhook —
+и пересылает каждое воркеру, которому принадлежит пользователь
+(user_id % SHARD_COUNT). Воркер обрабатывает обновления своих пользователей
+и ведёт для них свой планировщик и свою часть outbox.
+
+Таблица leases не даёт двум процессам одновременно быть роутером или
+владеть одним шардом: аренда продлевается каждые LEASE_TTL_SEC / 3 секунд,
+а процесс, потерявший аренду, останавливается.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from app.config import LEASE_TTL_SEC, TELEGRAM_RATE_LIMIT_PER_SEC
+from app.db import (
+    init_db,
+    load_messages_to_db,
+    close_db,
+    acquire_lease,
+    release_lease,
+    set_shard,
+)
+from app.data.messages import get_all_messages
+from app.data.scenario import build_scenario
+from app.logs import setup_logging, shard_log_file
+from app.scheduler import clear_schedule, send_training_messages
+from app.services.delivery import set_rate_limit
+from app.services.sessions import clear_sessions
+
+logger = logging.getLogger(__name__)
+
+ROUTER_LEASE = "router"
+
+# Сколько ждать завершения воркеров при остановке и как часто их проверять
+STOP_TIMEOUT_SEC = 30
+SUPERVISE_INTERVAL_SEC = 5
+
+# В процессе-воркере: очередь команд роутеру и номер своего шарда
+_control: Optional[multiprocessing.Queue] = None
+_shard_index: Optional[int] = None
+
+
+def lease_owner() -> str:
+    """Идентификатор процесса для таблицы аренд"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def shard_of(user_id: int, count: int) -> int:
+    """Номер шарда пользователя"""
+    return user_id % count
+
+
+def broadcast(command: str):
+    """
+    Передать команду остальным воркерам через роутер (reset, send_now).
+    Без шардирования ничего не делает — всё и так в одном процессе.
+    """
+    if _control is not None:
+        _control.put((command, _shard_index))
+
+
+async def _wait_lease(name: str, owner: str):
+    """Дождаться аренды (пока её держит другой процесс)"""
+    while not await acquire_lease(name, owner, LEASE_TTL_SEC):
+        logger.warning(f"Аренда {name} занята другим процессом, ожидание...")
+        await asyncio.sleep(LEASE_TTL_SEC / 3)
+
+
+async def _keep_lease(name: str, owner: str, on_lost):
+    """Продлевать аренду; при потере (или смерти родителя воркера) вызвать on_lost"""
+    parent = multiprocessing.parent_process()
+    while True:
+        await asyncio.sleep(LEASE_TTL_SEC / 3)
+        if parent is not None and not parent.is_alive():
+            logger.error("Роутер завершился, воркер останавливается")
+            on_lost()
+            return
+        try:
+            held = await acquire_lease(name, owner, LEASE_TTL_SEC)
+        except Exception as e:
+            # Временная ошибка БД: аренда ещё действует, попробуем снова
+            logger.error(f"Ошибка продления аренды {name}: {e}")
+            continue
+        if not held:
+            logger.critical(f"Аренда {name} потеряна — её забрал другой процесс")
+            on_lost()
+            return
+
+
+# ===== Воркер шарда =====
+
+def _worker_entry(index: int, count: int, updates: multiprocessing.Queue,
+                  control: multiprocessing.Queue):
+    """Точка входа процесса-воркера"""
+    # Останавливает воркер роутер (командой stop), а не Ctrl+C в терминале
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker_main(index, count, updates, control))
+
+
+def _get_item(updates: multiprocessing.Queue):
+    """Следующий элемент очереди (None, если за секунду ничего не пришло)"""
+    try:
+        return updates.get(timeout=1)
+    except queue.Empty:
+        return None
+
+
+async def _handle_control(command: str):
+    """Команда от другого воркера"""
+    if command == "reset":
+        clear_schedule()
+        clear_sessions()
+    elif command == "send_now":
+        await send_training_messages()
+
+
+async def _worker_main(index: int, count: int, updates: multiprocessing.Queue,
+                       control: multiprocessing.Queue):
+    """Воркер: своя рассылка и обработка обновлений своих пользователей"""
+    global _control, _shard_index
+    # Импорт здесь: app.main настраивает логирование и импортирует этот модуль
+    from app.main import create_bot, create_dispatcher, start_services, stop_services
+
+    # Свой файл лога: ротировать общий файл из нескольких процессов небезопасно
+    setup_logging(shard_log_file(index))
+    _control, _shard_index = control, index
+    set_shard(index, count)
+    # Общий лимит Bot API делится между воркерами
+    set_rate_limit(TELEGRAM_RATE_LIMIT_PER_SEC / count)
+
+    name = f"shard-{index}"
+    owner = lease_owner()
+    await init_db()
+    await _wait_lease(name, owner)
+    build_scenario(get_all_messages())
+
+    bot = create_bot()
+    dp = create_dispatcher()
+    await start_services(bot)
+    logger.info(f"✅ Воркер шарда {index}/{count} запущен")
+
+    stopping = asyncio.Event()
+    keeper = asyncio.create_task(_keep_lease(name, owner, stopping.set))
+    tasks = set()
+
+    try:
+        while not stopping.is_set():
+            item = await asyncio.to_thread(_get_item, updates)
+            if item is None:
+                continue
+            kind, payload = item
+            if kind == "stop":
+                break
+            if kind == "update":
+                task = asyncio.create_task(dp.feed_raw_update(bot, payload))
+            else:
+                task = asyncio.create_task(_handle_control(payload))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        keeper.cancel()
+        # Дать обработчикам закончить, затем остановить рассылку
+        if tasks:
+            await asyncio.wait(tasks, timeout=STOP_TIMEOUT_SEC)
+        await stop_services()
+        await release_lease(name, owner)
+        await close_db()
+        await bot.session.close()
+        logger.info(f"👋 Воркер шарда {index}/{count} остановлен")
+
+
+# ===== Роутер =====
+
+class ShardRouter:
+    """Процессы-воркеры и очереди, по которым им раздаются обновления"""
+
+    def __init__(self, count: int):
+        self.count = count
+        self._ctx = multiprocessing.get_context("spawn")
+        self.queues: List[multiprocessing.Queue] = [self._ctx.Queue() for _ in range(count)]
+        self.control = self._ctx.Queue()
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * count
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        process = self._ctx.Process(
+            target=_worker_entry,
+            args=(index, self.count, self.queues[index], self.control),
+            name=f"shard-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+
+    async def start(self):
+        """Запустить воркеры и пересылку команд между ними"""
+        for index in range(self.count):
+            self._spawn(index)
+        self._tasks = [
+            asyncio.create_task(self._relay_control()),
+            asyncio.create_task(self._supervise()),
+        ]
+        logger.info(f"🔀 Запущено воркеров шардов: {self.count}")
+
+    def route(self, update: Update):
+        """Переслать обновление воркеру, которому принадлежит пользователь"""
+        user = getattr(update.event, "from_user", None)
+        index = shard_of(user.id, self.count) if user else 0
+        self.queues[index].put(("update", update.model_dump(mode="json", exclude_unset=True)))
+
+    async def _relay_control(self):
+        """Разослать команду воркера всем остальным воркерам"""
+        while True:
+            item = await asyncio.to_thread(_get_item, self.control)
+            if item is None:
+                continue
+            command, origin = item
+            for index, updates in enumerate(self.queues):
+                if index != origin:
+                    updates.put(("control", command))
+
+    async def _supervise(self):
+        """Перезапускать упавшие воркеры"""
+        while not self._stopping:
+            await asyncio.sleep(SUPERVISE_INTERVAL_SEC)
+            for index, process in enumerate(self.processes):
+                if not self._stopping and process is not None and not process.is_alive():
+                    logger.error(f"Воркер шарда {index} завершился (код {process.exitcode}), перезапуск")
+                    self._spawn(index)
+
+    async def stop(self):
+        """Остановить воркеры, дав им доработать"""
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        for updates in self.queues:
+            updates.put(("stop", None))
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, STOP_TIMEOUT_SEC)
+            if process.is_alive():
+                logger.warning(f"Воркер шарда {index} не остановился, завершаем принудительно")
+                process.terminate()
+
+
+def create_router_dispatcher(count: int) -> Dispatcher:
+    """
+    Диспетчер процесса-роутера: без обработчиков, каждое обновление
+    пересылается воркеру шарда.
+    """
+    dp = Dispatcher()
+    router = ShardRouter(count)
+    owner = lease_owner()
+    keeper: List[asyncio.Task] = []
+
+    async def forward(handler, event: Update, data):
+        router.route(event)
+
+    dp.update.outer_middleware(forward)
+
+    def on_lost():
+        # Ведущим стал другой процесс — останавливаемся как по Ctrl+C
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    async def on_startup(bot: Bot):
+        logger.info("🚀 Роутер шардов запускается...")
+        await init_db()
+        await _wait_lease(ROUTER_LEASE, owner)
+        keeper.append(asyncio.create_task(_keep_lease(ROUTER_LEASE, owner, on_lost)))
+        # Сценарий загружается в БД один раз, до старта воркеров
+        await load_messages_to_db(get_all_messages())
+        await router.start()
+        logger.info("✅ Роутер шардов запущен")
+
+    async def on_shutdown(bot: Bot):
+        logger.info("⏹️ Роутер шардов останавливается...")
+        for task in keeper:
+            task.cancel()
+        await router.stop()
+        await release_lease(ROUTER_LEASE, owner)
+        await close_db()
+        logger.info("👋 Роутер шардов остановлен")
+
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
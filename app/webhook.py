@@ -0,0 +1,106 @@
+"""
+Режим webhook: aiohttp-сервер вместо long polling.
+
+Telegram присылает обновления на WEBHOOK_BASE_URL + WEBHOOK_PATH с секретом
+в заголовке X-Telegram-Bot-Api-Secret-Token. Запуск и остановка бота
+(on_startup / on_shutdown диспетчера) привязаны к жизненному циклу
+aiohttp-приложения, HEALTH_PATH отдаёт состояние для балансировщика.
+"""
+import asyncio
+import logging
+import signal
+from typing import List
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from app.config import (
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    HEALTH_PATH,
+)
+
+logger = logging.getLogger(__name__)
+
+# Бот готов принимать обновления (startup завершён, shutdown не начат)
+_ready = False
+
+
+async def health(request: web.Request) -> web.Response:
+    """Проверка живости для балансировщика / мониторинга"""
+    status = 200 if _ready else 503
+    return web.json_response({"status": "ok" if _ready else "starting", "mode": "webhook"}, status=status)
+
+
+async def register_webhook(bot: Bot, allowed_updates: List[str]):
+    """Установить webhook в Telegram и начать принимать обновления"""
+    global _ready
+    url = WEBHOOK_BASE_URL.rstrip('/') + WEBHOOK_PATH
+    await bot.set_webhook(
+        url,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=allowed_updates,
+    )
+    _ready = True
+    logger.info(f"🌐 Webhook установлен: {url}")
+
+
+def build_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """Собрать aiohttp-приложение: webhook, health и жизненный цикл бота"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    app.router.add_get(HEALTH_PATH, health)
+    setup_application(app, dp, bot=bot)
+
+    async def mark_stopping(app: web.Application):
+        global _ready
+        _ready = False
+
+    # Webhook не удаляем: пока бот перезапускается, Telegram копит обновления
+    app.on_shutdown.insert(0, mark_stopping)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, allowed_updates: List[str]):
+    """Запустить сервер и работать до SIGINT/SIGTERM"""
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("Для режима webhook укажите WEBHOOK_BASE_URL")
+    if not WEBHOOK_SECRET:
+        logger.warning("⚠️ WEBHOOK_SECRET не задан — запросы к webhook не проверяются")
+
+    runner = web.AppRunner(build_app(dp, bot))
+    try:
+        await runner.setup()
+        # После startup диспетчера (БД, планировщик) — только тогда принимаем обновления
+        await register_webhook(bot, allowed_updates)
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+        await site.start()
+        logger.info(f"🤖 Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                # Windows: остановка по KeyboardInterrupt
+                pass
+
+        await stop.wait()
+    finally:
+        try:
+            if runner.server is None:
+                # Startup диспетчера упал посередине: cleanup не вызовет on_shutdown,
+                # а незакрытый пул БД не даст процессу завершиться
+                await dp.emit_shutdown(bot=bot)
+        finally:
+            # cleanup вызывает on_shutdown: дожидается обработчиков и останавливает бота
+            await runner.cleanup()